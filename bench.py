@@ -17,28 +17,412 @@
 #-------------------------------------------------------------------------------
 
 
-import time
-import compiler
+import io
+import gc
+import sys
+import json
+import math
+import random
+import platform
+import argparse
+from time import perf_counter
 
+import llvmlite
+from lexer import stream_lexer, tokens, engines
+from sqyparser import Parser
+from optimizer import fold
+from myeval import Evaluator
+from codegen import CodeGen
+import vm
 
-def main ():
 
-    measure = []
-    program = open("code.txt").read()
-    program = program.replace("\n","\\n")
-    program = program.replace("\t","\\t")
+#--------------------------------------------------------------------------------------------
+# BENCHMARKS
+#
+# python bench.py                                 all the stages and corpora
+# python bench.py --stage parser --size 10000     only some of them
+# python bench.py --json base.json                save the results
+# python bench.py --compare base.json             exit status 1 if a stage is slower
+# python bench.py --stage lexer --engine scan      lexer engine (see lexer.lexer)
+#
+# Each stage of the compiler is timed alone over synthetic programs of growing size:
+#
+#   lexer     stream_lexer of the program, every token
+#   parser    Parser().ast of the tokens (lexer.TokenBuffer of the stream, already lexed)
+#   fold      optimizer.fold of the tree
+#   eval      myeval.Evaluator, interpreter mode
+#   vm        bytecode compilation and run (vm.Compiler, vm.run)
+#   ir        CodeGen.generate, LLVM IR of the tree
+#   llvm      CodeGen.emit_object: IR parsing, verification, -O passes, native code
+#
+# The programs are read as the compiler reads a file (main.front_end): a text stream
+# (io.StringIO), real newlines and tabs are statements. The input of a stage is
+# prepared out of the timed region. Each measure runs
+# <warmup> times untimed and <repeat> times timed, with the garbage collector
+# disabled (as timeit) unless --gc.
+
+
+# corpus -> program generator, see chain() and program()
+corpora = {}
+
+
+SIZES = (100, 1000, 10000)
+REPEAT = 7
+WARMUP = 2
+THRESHOLD = 0.10
+
+# timings under it (seconds) are never reported as regressions, noise
+NOISE = 50e-6
+
+
+def corpus (fn):
+
+    corpora[fn.__name__] = fn
+    return fn
+
+
+#--------------------------------------------------------------------------------------------
+# CORPORA
+
+
+@corpus
+def chain (size):
+
+    """1+1+...+1 with <size> terms. One long expression.
+    """
+
+    return "+".join(["1"] * size)
+
+
+@corpus
+def program (size):
+
+    """<size> statements: assignments, expressions and prints over the
+    names defined before. The values stay small (division), the runs
+    of the interpreters do not grow big ints.
+    """
+
+    rand = random.Random(size)
+    lines = ["v0:7"]
+    names = ["v0"]
+    for i in range(1, size):
+        a, b = rand.choice(names), rand.choice(names)
+        k = rand.randint(1, 5)
+        m = rand.randint(k + 2, 9)
+        if i % 8 == 6:
+            lines.append('print("v%d = ", %s, " ", %s < %s)' % (i, a, a, b))
+        elif i % 8 == 7:
+            lines.append("%s-%d*(%s+%d)" % (a, k, b, m))
+        else:
+            lines.append("v%d:(%s+%s*%d)/%d" % (i, a, b, k, m))
+            names.append("v%d" % i)
+    return "\n".join(lines)
+
+
+#--------------------------------------------------------------------------------------------
+# STAGES
+#
+# setup(source, options) -> state, out of the timed region
+# run(state) -> the timed code
+
+
+def parse (source):
+
+    return Parser().ast(io.StringIO(source))
+
+
+def lexer_setup (source, options):
+
+    return io.StringIO(source), options.engine
+
+def lexer_run (state):
+
+    stream, engine = state
+    for token in stream_lexer(stream, engine=engine):
+        pass
+
+
+def parser_setup (source, options):
+
+    return tokens(io.StringIO(source), options.engine)
+
+def parser_run (buffer):
+
+    Parser().ast(buffer)
+
+
+def fold_setup (source, options):
+
+    tree, scope = parse(source)
+    return tree
+
+
+def eval_setup (source, options):
+
+    return parse(source)
+
+def eval_run (state):
+
+    tree, scope = state
+    evaluator = Evaluator(scope)
+    for node in tree.first:
+        evaluator.eval(node)
+
+
+def vm_setup (source, options):
+
+    tree, scope = parse(source)
+    return tree
+
+def vm_run (tree):
+
+    code = vm.Compiler().compile(tree)
+    vm.run(code, output=io.StringIO())
+
+
+def ir_setup (source, options):
+
+    tree, scope = parse(source)
+    return tree, scope, CodeGen(opt_level=options.opt_level)
+
+def ir_run (state):
+
+    tree, scope, codegen = state
+    codegen.generate(tree, scope)
+
+
+def llvm_setup (source, options):
+
+    tree, scope = parse(source)
+    codegen = CodeGen(opt_level=options.opt_level)
+    codegen.generate(tree, scope)
+    return codegen
+
+def llvm_run (codegen):
+
+    codegen.emit_object()
+
+
+# stage -> (setup, run)
+stages = {"lexer": (lexer_setup, lexer_run),
+          "parser": (parser_setup, parser_run),
+          "fold": (fold_setup, fold),
+          "eval": (eval_setup, eval_run),
+          "vm": (vm_setup, vm_run),
+          "ir": (ir_setup, ir_run),
+          "llvm": (llvm_setup, llvm_run)}
+
+
+#--------------------------------------------------------------------------------------------
+# MEASURE
+
+
+def percentile (values, p):
+
+    """<p> percentile (0..100) of the sorted <values>, linear interpolation.
+    """
+
+    if len(values) == 1:
+        return values[0]
+    k = (len(values) - 1) * p / 100
+    low = math.floor(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def summary (times):
+
+    """Statistics of the <times> (seconds).
+    """
+
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    variance = sum((t - mean) ** 2 for t in times) / max(len(times) - 1, 1)
+    return {"min": times[0],
+            "median": percentile(times, 50),
+            "p90": percentile(times, 90),
+            "max": times[-1],
+            "mean": mean,
+            "stdev": math.sqrt(variance)}
+
+
+def measure (setup, run, source, options):
+
+    """Times of <run> with a new state from <setup> each time.
+    <options.warmup> untimed runs, then <options.repeat> timed.
+    """
+
+    times = []
+    for i in range(options.warmup + options.repeat):
+        state = setup(source, options)
+        gc.collect()
+        enabled = gc.isenabled()
+        if not options.gc:
+            gc.disable()
+        try:
+            start = perf_counter()
+            run(state)
+            end = perf_counter()
+        finally:
+            if enabled:
+                gc.enable()
+        if i >= options.warmup:
+            times.append(end - start)
+        del state
+    return times
+
+
+def benchmark (options, log=sys.stdout):
+
+    """Runs the selected stages over the selected corpora and sizes.
+    Return the list of results (dict).
+    """
+
+    results = []
+    for name in options.corpus:
+        for size in options.size:
+            source = corpora[name](size)
+            for stage_name in options.stage:
+                setup, run = stages[stage_name]
+                times = measure(setup, run, source, options)
+                result = {"stage": stage_name, "corpus": name, "size": size,
+                          "bytes": len(source), "times": times}
+                result.update(summary(times))
+                results.append(result)
+                if log is not None:
+                    log.write(row(result) + "\n")
+                    log.flush()
+    return results
+
+
+#--------------------------------------------------------------------------------------------
+# REPORTS
+
+
+HEADER = "%-8s %-8s %7s %9s %10s %10s %10s %9s" % ("stage", "corpus", "size", "bytes",
+                                                   "min ms", "median ms", "p90 ms", "stdev %")
+
+
+def row (result):
+
+    stdev = 100 * result["stdev"] / result["mean"] if result["mean"] else 0.0
+    return "%-8s %-8s %7d %9d %10.3f %10.3f %10.3f %9.1f" % (
+        result["stage"], result["corpus"], result["size"], result["bytes"],
+        result["min"] * 1e3, result["median"] * 1e3, result["p90"] * 1e3, stdev)
+
+
+def report (results, options):
+
+    """Results as JSON, with the environment of the run.
+    """
+
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "llvmlite": llvmlite.__version__,
+            "machine": platform.machine(),
+            "system": platform.system(),
+            "opt_level": options.opt_level,
+            "engine": options.engine,
+            "repeat": options.repeat,
+            "warmup": options.warmup,
+            "gc": options.gc,
+            "results": results}
+
+
+def key (result):
+
+    return (result["stage"], result["corpus"], result["size"])
+
+
+def compare (results, baseline, current=None, threshold=THRESHOLD, log=sys.stdout):
+
+    """Compares the medians of <results> with the <baseline> report (JSON).
+    <current> -- report of the run, a different environment is warned.
+    A measure is a regression when it is slower than the baseline by more than
+    <threshold> (0.10 is 10%). Return the list of regressions (result, base).
+    """
+
+    base = {key(result): result for result in baseline["results"]}
+    regressions = []
+
+    log.write("\n%-8s %-8s %7s %12s %12s %8s\n" % ("stage", "corpus", "size",
+                                                 "base ms", "median ms", "ratio"))
+    for result in results:
+        old = base.get(key(result))
+        if old is None:
+            continue
+        ratio = result["median"] / old["median"] if old["median"] else float("inf")
+        slower = ratio > 1 + threshold and result["median"] - old["median"] > NOISE
+        if slower:
+            regressions.append((result, old))
+        log.write("%-8s %-8s %7d %12.3f %12.3f %8.2f%s\n" % (
+            result["stage"], result["corpus"], result["size"], old["median"] * 1e3,
+            result["median"] * 1e3, ratio, "  REGRESSION" if slower else ""))
+
+    for name in ("python", "llvmlite", "machine", "opt_level", "engine", "gc"):
+        if current is not None and baseline.get(name) != current[name]:
+            log.write("warning: %s %s, baseline %s\n" % (name, current[name], baseline.get(name)))
+
+    return regressions
+
+
+#--------------------------------------------------------------------------------------------
+
+
+def names (value):
+
+    return [x for x in value.split(",") if x]
+
+
+def main (argv=None):
+
+    parser = argparse.ArgumentParser(description="Squanchy compiler benchmarks")
+    parser.add_argument("--stage", type=names, default=list(stages),
+                        help="comma separated stages: " + ",".join(stages))
+    parser.add_argument("--corpus", type=names, default=list(corpora),
+                        help="comma separated corpora: " + ",".join(corpora))
+    parser.add_argument("--size", type=lambda x: [int(n) for n in names(x)], default=list(SIZES),
+                        help="comma separated program sizes (terms or statements)")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="timed runs of each measure")
+    parser.add_argument("--warmup", type=int, default=WARMUP, help="untimed runs before")
+    parser.add_argument("-O", dest="opt_level", type=int, default=0, choices=CodeGen.opt_levels,
+                        help="optimization level of the ir and llvm stages")
+    parser.add_argument("--gc", action="store_true", help="garbage collector enabled while timing")
+    parser.add_argument("--engine", default="regex", choices=engines,
+                        help="lexer engine of the lexer and parser stages (default: regex)")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="baseline JSON (--json) to compare with")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="slowdown of the median reported as regression (0.10 = 10%%)")
+    options = parser.parse_args(argv)
 
-    for i in range (1000):
-        start = time.time()   
-        compiler.parseFile("code_py.txt")
-        end = time.time()
-        measure.append(end-start)
+    for value, known, what in ((options.stage, stages, "stage"), (options.corpus, corpora, "corpus")):
+        for name in value:
+            if name not in known:
+                parser.error("unknown %s %r" % (what, name))
+    if options.repeat < 1 or options.warmup < 0:
+        parser.error("--repeat must be positive and --warmup not negative")
 
-    sqyt = float(sum(measure)/len(measure))
-    print "py time >>",sqyt
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
 
+    print (HEADER)
+    results = benchmark(options)
 
-main()
+    current = report(results, options)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(current, f, indent=2)
 
+    if baseline is not None:
+        regressions = compare(results, baseline, current, options.threshold)
+        if regressions:
+            print ("\n%d regression(s) over %d%%" % (len(regressions), round(options.threshold * 100)))
+            return 1
+    return 0
 
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 2018 Marcos V. Conde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+
+import os
+import hashlib
+import tempfile
+import llvmlite
+
+
+#--------------------------------------------------------------------------------------------
+# COMPILATION CACHE
+#
+# Object code (and bitcode, optional) of the compiled modules, on disk:
+#
+#   ~/.cache/squanchy/ab/abcdef....o
+#
+# The key is a hash of the source (digest), the compiler version, the optimization
+# level, the target triple, the entry function, the kind of object
+# ("obj" for the linker, "jit" for MCJIT) and the front end options.
+# Least recently used entries are removed when the cache grows over max_size bytes:
+# the size is counted once (os.walk) and then kept, stores add to it.
+
+
+MAX_SIZE = 256 * 1024 * 1024
+
+CHUNK = 64 * 1024 # bytes read at once by digest
+
+# compiler modules, any change in them invalidates the cache
+sources = ("lexer.py", "sqyparser.py", "myeval.py", "optimizer.py", "inference.py",
+           "codegen.py", "main.py")
+
+_version = None
+
+
+def compiler_version ():
+
+    """Hash of the compiler sources and the llvmlite version.
+    """
+
+    global _version
+    if _version is None:
+        h = hashlib.sha256(llvmlite.__version__.encode())
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in sources:
+            with open(os.path.join(here, name), "rb") as f:
+                h.update(f.read())
+        _version = h.hexdigest()
+    return _version
+
+
+def digest (source):
+
+    """Hash of the <source>: text (str) or binary file, read in chunks.
+    """
+
+    h = hashlib.sha256()
+    if isinstance(source, str):
+        h.update(source.encode("utf8"))
+    else:
+        for chunk in iter(lambda: source.read(CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def default_directory ():
+
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.environ.get("SQUANCHY_CACHE", os.path.join(base, "squanchy"))
+
+
+class ObjectCache():
+
+    """On disk cache of compiled modules, size bounded (LRU).
+    directory -- $SQUANCHY_CACHE or ~/.cache/squanchy by default
+    max_size -- bytes
+    bitcode -- also keep the LLVM bitcode of the modules
+    """
+
+    def __init__(self, directory=None, max_size=MAX_SIZE, bitcode=False):
+        self.directory = directory or default_directory()
+        self.max_size = max_size
+        self.bitcode = bitcode
+        self._size = None # bytes in the cache, None until counted
+
+    def key(self, source, opt_level=0, triple="", entry="main", kind="obj", options=()):
+        """
+        Cache key of the module compiled from the source with the hash <source>
+        (see digest).
+        """
+        h = hashlib.sha256()
+        for part in (compiler_version(), str(opt_level), triple, entry, kind) + tuple(options):
+            h.update(part.encode())
+            h.update(b"\0")
+        h.update(source.encode())
+        return h.hexdigest()
+
+    def path(self, key, suffix=".o"):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key, suffix=".o"):
+        """
+        Cached data of <key> (bytes), None if not in the cache.
+        """
+        path = self.path(key, suffix)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # last use, for the LRU eviction
+        except OSError:
+            return None
+        return data
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, data, suffix=".o"):
+        """
+        Store <data> (bytes) for <key>. Atomic, several processes may
+        share the cache. Errors writing the cache are ignored.
+        Evicts when the running size (counted once, the stores of other
+        processes are seen at the next count) goes over max_size.
+        """
+        path = self.path(key, suffix)
+        if self._size is None:
+            self._size = self.size()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                self._size -= os.stat(path).st_size # replaced
+            except OSError:
+                pass
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            return
+        self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        """
+        (mtime, size, path) of every file in the cache.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_size.
+        """
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        if total > self.max_size:
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_size:
+                    break
+        self._size = total
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._size = None
@@ -21,34 +21,91 @@
 
 
 from llvmlite import ir, binding
-from myeval import Eval
+from myeval import Evaluator
+from inference import infer
+from ctypes import CFUNCTYPE, CDLL, c_bool, c_int32, c_int64, c_double
+import sys
+import instrument
+
+
+libc = CDLL(None)
+
+# LLVM type -> ctypes type, see CodeGen.function
+ctypes_types = {"i1": c_bool, "i32": c_int32, "i64": c_int64, "double": c_double}
+
+
+def declare_printf(module):
+    """
+    Declare the printf function in the ir.Module <module>.
+    """
+    voidptr_ty = ir.IntType(8).as_pointer()
+    printf_ty = ir.FunctionType(ir.IntType(32), [voidptr_ty], var_arg=True)
+    return ir.Function(module, printf_ty, name="printf")
 
 
 class CodeGen():
-    def __init__(self):
+
+    """LLVM module for a Squanchy program.
+    name -- module name (source file)
+    entry -- function with the top level code, "main" for a single file program:
+        int main() returning 0 (exit status), else void()
+    opt_level -- 0..3 like -O0..-O3, optimization passes and native code generation
+    cache -- cache.ObjectCache for the object code, keyed by <source>: hash of the
+        source, see cache.digest
+    options -- front end options that change the generated code (cache key)
+    export -- the functions of the program are exported: C calling convention and
+        external, for function() and other modules. Else internal fastcc, only the
+        entry function is visible (see Evaluator)
+    """
+
+    opt_levels = (0, 1, 2, 3)
+
+    def __init__(self, name=__file__, entry="main", opt_level=0, cache=None, source=None,
+                 options=(), export=False):
+        if opt_level not in self.opt_levels:
+            raise ValueError("invalid optimization level %r" % (opt_level,))
+        self.name = name
+        self.entry = entry
+        self.opt_level = opt_level
+        self.cache = cache
+        self.source = source
+        self.export = export
+        self.options = tuple(options) + (("export",) if export else ())
+        self._objects = {}
         self.binding = binding
         self.binding.initialize()
         self.binding.initialize_native_target()
         self.binding.initialize_native_asmprinter()
+        self._create_target_machine()
         self._config_llvm()
         self._create_execution_engine()
         self._declare_print_function()
+        self._llvm_module = None
+        self._compiled = False
+        self._linked = []
+
+    def _create_target_machine(self):
+        # Target machine for object and assembly emission.
+        # Position independent, the linker may build a PIE executable
+        target = self.binding.Target.from_default_triple()
+        self.target_machine = target.create_target_machine(opt=self.opt_level, reloc="pic")
 
     def _config_llvm(self):
         # Config LLVM
-        self.module = ir.Module(name=__file__)
+        self.module = ir.Module(name=self.name)
         self.module.triple = self.binding.get_default_triple()
-        func_type = ir.FunctionType(ir.VoidType(), [], False)
-        base_func = ir.Function(self.module, func_type, name="main")
+        self.module.data_layout = str(self.target_machine.target_data)
+        ret_type = ir.IntType(32) if self.entry == "main" else ir.VoidType()
+        func_type = ir.FunctionType(ret_type, [], False)
+        base_func = ir.Function(self.module, func_type, name=self.entry)
         block = base_func.append_basic_block(name="entry")
         self.builder = ir.IRBuilder(block)
+        self.strings = {} # string pool, format strings of print, see Evaluator.string
+        self.arrays = {} # constant list literals, see Evaluator.list_ir
 
     def _declare_print_function(self):
         # Declare Printf function
-        voidptr_ty = ir.IntType(8).as_pointer()
-        printf_ty = ir.FunctionType(ir.IntType(32), [voidptr_ty], var_arg=True)
-        printf = ir.Function(self.module, printf_ty, name="printf")
-        self.printf = printf
+        self.printf = declare_printf(self.module)
 
     def _create_execution_engine(self):
         """
@@ -57,31 +114,269 @@ class CodeGen():
         modules.
         """
         target = self.binding.Target.from_default_triple()
-        target_machine = target.create_target_machine()
+        target_machine = target.create_target_machine(opt=self.opt_level)
         # And an execution engine with an empty backing module
         backing_mod = binding.parse_assembly("")
         engine = binding.create_mcjit_compiler(backing_mod, target_machine)
+        if self.cache is not None and self.source is not None:
+            engine.set_object_cache(self._notify_object, self._get_object)
         self.engine = engine
 
+    #---------------------------------------------------------------------------
+    # Object cache
+
+    def _cache_key(self, kind):
+        if self.cache is None or self.source is None:
+            return None
+        return self.cache.key(self.source, self.opt_level, self.module.triple, self.entry, kind,
+                              self.options)
+
+    def _cached_object(self, kind):
+        # Loaded once and kept, the entry may be evicted meanwhile
+        if kind not in self._objects:
+            key = self._cache_key(kind)
+            self._objects[kind] = None if key is None else self.cache.get(key)
+        return self._objects[kind]
+
+    def cached(self, kind="obj"):
+        """
+        True if the object code of the module is in the cache,
+        then generate() is not needed.
+        kind -- "obj" for emit_object, "jit" for run/call
+        """
+        return self._cached_object(kind) is not None
+
+    def _get_object(self, mod):
+        # MCJIT hook, object code of <mod> or None to compile it
+        if mod.name == self.name:
+            return self._cached_object("jit")
+        return None
+
+    def _notify_object(self, mod, obj):
+        # MCJIT hook, <mod> compiled to <obj>
+        if mod.name == self.name and self._cached_object("jit") is None:
+            self.cache.put(self._cache_key("jit"), obj)
+
+    def _finish(self):
+        # Close the entry function, once
+        if not self.builder.block.is_terminated:
+            if self.entry == "main":
+                self.builder.ret(ir.IntType(32)(0))
+            else:
+                self.builder.ret_void()
+
+    def optimize(self, mod):
+        """
+        Run the -O<opt_level> pipeline of LLVM on <mod> (binding.ModuleRef):
+        mem2reg/SROA, instcombine, GVN, inlining, loop passes...
+        Nothing at -O0.
+        """
+        if not self.opt_level:
+            return
+        with instrument.stage("llvm passes", file=self.name, opt_level=self.opt_level):
+            options = self.binding.create_pipeline_tuning_options(speed_level=self.opt_level)
+            options.loop_vectorization = self.opt_level > 1
+            options.slp_vectorization = self.opt_level > 1
+            builder = self.binding.create_pass_builder(self.target_machine, options)
+            passes = builder.getModulePassManager()
+            passes.run(mod, builder)
+
+    def llvm_module(self):
+        """
+        LLVM module object (binding.ModuleRef) parsed from the IR,
+        verified and optimized. Parsed only once.
+        """
+        if self._llvm_module is None:
+            self._finish()
+            with instrument.stage("llvm parse", file=self.name):
+                llvm_ir = str(self.module)
+                mod = self.binding.parse_assembly(llvm_ir)
+                mod.name = self.name
+                for other in self._linked:
+                    mod.link_in(other, preserve=True)
+                mod.verify()
+            if instrument.enabled():
+                instrument.count("IR instructions", self.instructions())
+                instrument.count("IR bytes", len(llvm_ir))
+            self.optimize(mod)
+            self._llvm_module = mod
+        return self._llvm_module
+
+    def _stub_module(self):
+        # Empty module for the engine, its code comes from the cache
+        mod = self.binding.parse_assembly("")
+        mod.name = self.name
+        mod.triple = self.module.triple
+        mod.data_layout = self.module.data_layout
+        return mod
+
     def _compile_ir(self):
         """
-        Compile the LLVM IR string with the given engine.
+        Compile the LLVM IR string with the given engine, once.
         The compiled module object is returned.
         """
-        # Create a LLVM module object from the IR
-        self.builder.ret_void()
-        llvm_ir = str(self.module)
-        mod = self.binding.parse_assembly(llvm_ir)
-        mod.verify()
+        if self._compiled:
+            return self._llvm_module
+        if self.cached("jit"):
+            instrument.count("cache hits")
+            mod = self._llvm_module = self._stub_module()
+        else:
+            # Create a LLVM module object from the IR
+            mod = self.llvm_module()
         # Now add the module and make sure it is ready for execution
-        self.engine.add_module(mod)
-        self.engine.finalize_object()
-        self.engine.run_static_constructors()
+        with instrument.stage("jit", file=self.name):
+            self.engine.add_module(mod)
+            self.engine.finalize_object()
+            self.engine.run_static_constructors()
+        self._compiled = True
+        return mod
+
+    def generate(self, tree, scope, linked=(), types=None):
+        """
+        Generate the code of the statements of <tree> (Module node)
+        in the entry function. The names its functions, and the Function
+        nodes <linked> (see link_in), read from the top level are globals.
+        Every function is declared first, the code can call them in any order.
+        types -- inference.Types of the program, inferred if None
+        """
+        nodes = list(tree.first or []) + list(linked)
+        if types is None:
+            with instrument.stage("types", file=self.name):
+                types = infer(nodes)
+        with instrument.stage("ir", file=self.name):
+            evaluator = Evaluator(scope, self.builder, self.module, self.printf, self.strings,
+                                  self.export, types, arrays=self.arrays)
+            evaluator.declare_globals(nodes)
+            evaluator.declare_functions(nodes)
+            for node in tree.first:
+                evaluator.eval(node)
+
+    def function_module(self, node, scope, types=None):
+        """
+        LLVM module (binding.ModuleRef) with only the function defined by the
+        Function <node>, for link_in. Same target as this module.
+        The function is exported, the other modules call it, and the other
+        functions of <types> are declared: it calls them in their modules.
+        types -- inference.Types of the whole program, else inferred from <node>
+        """
+        module = ir.Module(name="%s:%s" % (self.name, node.first.value))
+        module.triple = self.module.triple
+        module.data_layout = self.module.data_layout
+        if types is None:
+            types = infer([node])
+        evaluator = Evaluator(scope, ir.IRBuilder(), module, declare_printf(module), export=True,
+                              types=types)
+        evaluator.globals = set(types.names[None]) # assigned by the top level
+        for name, args in types.args.items():
+            evaluator.declare_function(name, len(args)) # defined here or in other modules
+        evaluator.eval(node)
+        mod = self.binding.parse_assembly(str(module))
+        mod.verify()
         return mod
 
+    def link_in(self, mod):
+        """
+        Link the LLVM module <mod> (binding.ModuleRef, not changed) into this one
+        when it is parsed, see llvm_module. Its functions are defined there.
+        """
+        if self._llvm_module is not None:
+            raise RuntimeError("module already compiled")
+        self._linked.append(mod)
+
+    def instructions(self):
+        """
+        Number of instructions of the LLVM IR of the module.
+        """
+        return sum(len(block.instructions) for func in self.module.functions
+                   for block in func.blocks)
+
+    def call_entries(self, entries):
+        """
+        Call from the entry function the void() functions <entries> (names),
+        in order: the entry functions of other modules, see main.startup_object.
+        """
+        func_type = ir.FunctionType(ir.VoidType(), [], False)
+        for entry in entries:
+            self.builder.call(ir.Function(self.module, func_type, name=entry), [])
+
     def create_ir(self):
         self._compile_ir()
 
+    def function(self, name):
+        """
+        Native function <name> of the module (JIT compiled) as a ctypes
+        function, with the types of its arguments and result (int64, double
+        or bool, see inference, not arrays); the entry function is void(),
+        or int() if it is main.
+        Only the entry function if the module comes from the cache, or if the
+        functions are not exported (CodeGen(export=True)).
+        """
+        self._compile_ir()
+        func = self.module.get_global(name)
+        if not isinstance(func, ir.Function) or func.linkage == "internal":
+            raise KeyError(name)
+        types = [func.ftype.return_type] + [arg.type for arg in func.args]
+        if any(str(ty) not in ctypes_types for ty in types[1:]) or \
+                not isinstance(types[0], ir.VoidType) and str(types[0]) not in ctypes_types:
+            raise TypeError("%s takes or returns arrays, not callable with ctypes" % name)
+        ret = None if isinstance(types[0], ir.VoidType) else ctypes_types[str(types[0])]
+        cfunc_ty = CFUNCTYPE(ret, *[ctypes_types[str(ty)] for ty in types[1:]])
+        return cfunc_ty(self.engine.get_function_address(name))
+
+    def call(self, name, *args):
+        """
+        Call the function <name> of the module in process (JIT)
+        and return its result.
+        """
+        func = self.function(name)
+        sys.stdout.flush()
+        try:
+            return func(*args)
+        finally:
+            # printf writes to the C stdout buffer
+            libc.fflush(None)
+
+    def run(self):
+        """
+        Run the top level code of the program (entry function) in process.
+        """
+        self.call(self.entry)
+
     def save_ir(self, filename):
         with open(filename, 'w') as output_file:
             output_file.write(str(self.module))
+
+    def optimized_ir(self):
+        """
+        LLVM IR of the module after the optimization passes, as text.
+        """
+        return str(self.llvm_module())
+
+    def emit_object(self, filename=None):
+        """
+        Native object code of the module, in process (no llc).
+        Written to <filename> if given. Return the object as bytes.
+        """
+        obj = self._cached_object("obj")
+        if obj is None:
+            mod = self.llvm_module()
+            with instrument.stage("object", file=self.name):
+                obj = self.target_machine.emit_object(mod)
+            key = self._cache_key("obj")
+            if key is not None:
+                self.cache.put(key, obj)
+                if self.cache.bitcode:
+                    self.cache.put(key, mod.as_bitcode(), suffix=".bc")
+        else:
+            instrument.count("cache hits")
+        instrument.count("object bytes", len(obj))
+        if filename is not None:
+            with open(filename, 'wb') as output_file:
+                output_file.write(obj)
+        return obj
+
+    def emit_assembly(self):
+        """
+        Native assembly of the module as text.
+        """
+        return self.target_machine.emit_assembly(self.llvm_module())
@@ -0,0 +1,346 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 2018 Marcos V. Conde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+
+#--------------------------------------------------------------------------------------------
+# TYPE INFERENCE
+#
+# tree,scope = ast(program)
+# types = infer(tree.first)
+# types.of(None, "a")           -> "int"    (top level name a)
+# types.signature("suma", 2)    -> (["int", "int"], "int")
+#
+# Types of the names and functions of a program for the code generator:
+#   bool  -- i1, comparisons and not
+#   int   -- i64, integer literals and arithmetic
+#   float -- double, float literals (1.56, pi) and arithmetic with a float
+#   int[], float[] -- arrays, list literals of numbers ([1, 2.5]) and element-wise
+#       + - * / of arrays (or of an array and a number); l.i is an element
+#
+# A name has one type in its function (or in the top level): the join of the types
+# of every value assigned to it, bool < int < float. The parameters of a function
+# join the types of the arguments of its calls, and its result the type of its
+# return expression. The program is walked again until no type changes (the types
+# only grow, so it ends). The unknown types are int. An array and a number never
+# join (TypeError).
+#
+# Flow insensitive and keyed by name, not by node: the nodes may be shared
+# (Parser(intern=...)), the same Add node can be int in one place and float in other.
+
+
+BOOL, INT, FLOAT = "bool", "int", "float"
+
+ranks = {BOOL: 0, INT: 1, FLOAT: 2}
+
+elementwise = ("+", "-", "*", "/")
+comparisons = ("=", "!=", "<", ">", "<=", ">=")
+logic = ("and", "or")
+assignments = (":", ":=")
+
+
+def literal (value):
+
+    """Number of the value of a Const: int, float or None (text, null).
+    """
+
+    if type(value) is int or type(value) is float:
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def array (t):
+
+    """Type of the arrays of elements of type <t>, the bools are stored as ints.
+    """
+
+    return (FLOAT if t == FLOAT else INT) + "[]"
+
+
+def element (t):
+
+    """Type of the elements of the array type <t>, None if it is not an array.
+    """
+
+    return t[:-2] if t is not None and t.endswith("[]") else None
+
+
+def join (a, b):
+
+    """Type of the values of types <a> and <b>, None is unknown.
+    """
+
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if element(a) and element(b):
+        return array(join(element(a), element(b)))
+    if element(a) or element(b):
+        raise TypeError("Values of types %s and %s mixed" % (a, b))
+    return a if ranks[a] >= ranks[b] else b
+
+
+def binary (id, a, b):
+
+    # type of <a> <id> <b>
+    if element(a) or element(b):
+        if id not in elementwise:
+            return None # not supported
+        return array(join(element(a) or a, element(b) or b))
+    if id in comparisons:
+        return BOOL
+    if id in logic:
+        return BOOL if a == BOOL and b == BOOL else INT
+    return FLOAT if FLOAT in (a, b) else INT
+
+
+def unary (id, a):
+
+    # type of <id> <a>
+    if id == "not":
+        return BOOL
+    if element(a):
+        return a
+    return FLOAT if a == FLOAT else INT
+
+
+class Types:
+
+    """Types of a program, see infer.
+    functions -- {function: [parameter types, result type]}
+    names -- {function (None: top level): {name: type}}
+    args -- {function: parameter names}
+    """
+
+    def __init__ (self):
+
+        self.functions = {}
+        self.names = {None: {}}
+        self.args = {}
+
+
+    def copy (self):
+
+        types = Types()
+        types.functions = {name: [list(params), ret] for name, (params, ret) in self.functions.items()}
+        types.names = {scope: dict(names) for scope, names in self.names.items()}
+        types.args = dict(self.args)
+        return types
+
+
+    def of (self, scope, name):
+
+        """Type of <name> in the function <scope> (None: top level): argument,
+        assigned in it or else a top level name (global). int if unknown.
+        """
+
+        return self.lookup(scope, name) or INT
+
+
+    def lookup (self, scope, name):
+
+        # type of <name> in <scope>, None if unknown
+        if scope is not None:
+            args = self.args.get(scope, ())
+            if name in args:
+                return self.functions[scope][0][args.index(name)]
+            names = self.names.get(scope, {})
+            if name in names:
+                return names[name]
+        return self.names[None].get(name)
+
+
+    def signature (self, name, arity):
+
+        """(parameter types, result type) of the function <name>, int if unknown.
+        """
+
+        params, ret = self.functions.get(name, ([None] * arity, None))
+        return [t or INT for t in params], ret or INT
+
+
+def infer (nodes, types=None):
+
+    """Types of the top level statements <nodes> (list) and of the functions
+    defined in them. <types> -- Types of the code before (REPL), extended.
+    Return Types.
+    """
+
+    types = Types() if types is None else types
+    nodes = nodes or []
+    functions = [node for node in nodes if node.id == "Function" and node.first.value != "print"]
+    top = [node for node in nodes if node not in functions]
+
+    for node in functions:
+        name = node.first.value
+        args = [x.value for x in node.second[0]]
+        types.args[name] = args
+        types.functions.setdefault(name, [[None] * len(args), None])
+        types.names.setdefault(name, {})
+
+    inference = Inference(types)
+    while True:
+        inference.changed = False
+        inference.statements(top, None)
+        for node in functions:
+            inference.function(node)
+        if not inference.changed:
+            return types
+
+
+class Inference:
+
+    """One walk of the program, grows <types>. <changed> -- a type grew.
+    Expressions with an explicit stack (long expressions), blocks with a call.
+    """
+
+    def __init__ (self, types):
+
+        self.types = types
+        self.changed = False
+
+
+    def grow (self, table, key, t):
+
+        # table[key] (dict or list) joined with the type <t>
+        old = table.get(key) if isinstance(table, dict) else table[key]
+        new = join(old, t)
+        if new != old:
+            table[key] = new
+            self.changed = True
+
+
+    def assign (self, scope, name, t):
+
+        if t is None:
+            return
+        types = self.types
+        if scope is not None and name in types.args.get(scope, ()):
+            self.grow(types.functions[scope][0], types.args[scope].index(name), t)
+        else:
+            self.grow(types.names[scope], name, t)
+
+
+    def function (self, node):
+
+        name = node.first.value
+        self.statements(node.third, name)
+        self.grow(self.types.functions[name], 1, self.expr(node.second[1][0], name))
+
+
+    def statements (self, nodes, scope):
+
+        for node in nodes or ():
+            self.expr(node, scope)
+
+
+    def expr (self, node, scope):
+
+        """Type of the expression <node> in the function <scope>, None if it
+        has no number (texts, statements).
+        """
+
+        results = []
+        stack = [node] # nodes and (node,) to complete
+
+        while stack:
+            node = stack.pop()
+
+            if type(node) is tuple:
+                node, = node
+                if node.id in assignments:
+                    t = results[-1]
+                    self.assign(scope, node.first.value, t)
+                elif node.arity == 2:
+                    b = results.pop()
+                    results[-1] = binary(node.id, results[-1], b)
+                else:
+                    results[-1] = unary(node.id, results[-1])
+                continue
+
+            id = node.id
+            if id == "Name":
+                results.append(self.types.lookup(scope, node.value))
+            elif id == "Const":
+                number = literal(node.value)
+                results.append(None if number is None else FLOAT if type(number) is float else INT)
+            elif id in assignments and operand(node.second) and operand(node.first) \
+                    and node.first.id == "Name":
+                stack.append((node,))
+                stack.append(node.second)
+            elif node.arity == 2 and operand(node.first) and operand(node.second):
+                stack.append((node,))
+                stack.append(node.second)
+                stack.append(node.first)
+            elif node.arity == 1 and node.id in ("+", "-", "not") and operand(node.first):
+                stack.append((node,))
+                stack.append(node.first)
+            else:
+                results.append(self.statement(node, scope))
+
+        return results[-1]
+
+
+    def statement (self, node, scope):
+
+        id = node.id
+
+        if id == "CallFunc":
+            args = [self.expr(arg, scope) for arg in node.second[0]]
+            name = getattr(node.first, "value", None)
+            if name not in self.types.functions:
+                return INT if name == "len" else None # print
+            params = self.types.functions[name][0]
+            for i, t in enumerate(args[:len(params)]):
+                if t is not None:
+                    self.grow(params, i, t)
+            return self.types.functions[name][1]
+
+        if id in ("if", "while"):
+            self.expr(node.first, scope)
+            self.statements(node.second, scope)
+            if id == "if":
+                self.statements(node.third, scope)
+            return None
+
+        if node.name in ("List", "Tuple"):
+            types = [self.expr(x, scope) for x in node.first]
+            if None in types or any(element(t) for t in types):
+                return None # texts
+            t = None
+            for x in types:
+                t = join(t, x)
+            return array(t)
+
+        if id == ".":
+            self.expr(node.second, scope)
+            return element(self.expr(node.first, scope))
+
+        return None # functions...
+
+
+def operand (node):
+
+    return node is not None and not isinstance(node, (list, str))
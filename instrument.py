@@ -0,0 +1,279 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 2018 Marcos V. Conde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+
+import os
+import sys
+import json
+from time import perf_counter
+
+
+#--------------------------------------------------------------------------------------------
+# INSTRUMENTATION
+#
+# instrument.enable()
+# with instrument.stage("parser", file=path):
+#     tree,scope = Parser().ast(source)
+# instrument.count("tokens", n)
+# print (instrument.report.table())
+#
+# Wall time and allocated memory blocks (sys.getallocatedblocks, net: allocated
+# minus freed) of each stage of the compiler, and counters (tokens, AST nodes,
+# IR instructions, module and object sizes...). See main.py --time-report.
+#
+# Disabled by default: stage() returns a shared context manager that does
+# nothing and count() returns at once, the compiler does not pay for it.
+# The worker processes of the build record their own Report and send it back
+# with the results, see Report.merge.
+
+
+class Report:
+
+    """Stages and counters recorded since it was created.
+    events -- (name, start, duration, blocks, pid, depth, args), times in seconds
+        from perf_counter (CLOCK_MONOTONIC on Linux, the same in every process)
+    counters -- (name, value, time, pid)
+    """
+
+    def __init__ (self):
+
+        self.start = perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.counters = []
+        self.depth = 0
+
+
+    def stage (self, name, **args):
+
+        return Stage(self, name, args)
+
+
+    def count (self, name, value=1):
+
+        self.counters.append((name, value, perf_counter(), self.pid))
+
+
+    def dump (self):
+
+        """Events and counters, picklable (worker processes).
+        """
+
+        return self.events, self.counters
+
+
+    def merge (self, dump):
+
+        """Adds the events and counters of other Report.dump(), nested
+        in the stages running now.
+        """
+
+        events, counters = dump
+        depth = self.depth
+        self.events.extend(event[:5] + (event[5] + depth,) + event[6:] for event in events)
+        self.counters.extend(counters)
+
+
+    def totals (self):
+
+        """{counter: sum of its values}, in order of appearance.
+        """
+
+        totals = {}
+        for name, value, time, pid in self.counters:
+            totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+    def stages (self):
+
+        """[name, calls, seconds, blocks, depth] of each stage, in order of start.
+        depth -- nesting level of its first call
+        """
+
+        stages = {}
+        for name, start, duration, blocks, pid, depth, args in sorted(self.events, key=lambda e: e[1]):
+            row = stages.setdefault(name, [name, 0, 0.0, 0, depth])
+            row[1] += 1
+            row[2] += duration
+            row[3] += blocks
+        return list(stages.values())
+
+
+    def table (self):
+
+        """Report as text, like clang -ftime-report.
+        """
+
+        total = perf_counter() - self.start
+        line = "===" + "-" * 69 + "==="
+        lines = [line, "Squanchy time report".center(len(line)), line,
+                 "  Total wall time: %.4f seconds" % total, "",
+                 "  %10s %7s %7s %10s  %s" % ("wall s", "%", "calls", "blocks", "stage")]
+        for name, calls, seconds, blocks, depth in self.stages():
+            lines.append("  %10.4f %6.1f%% %7d %10d  %s%s" % (
+                seconds, 100 * seconds / total if total else 0.0, calls, blocks, "  " * depth, name))
+        totals = self.totals()
+        if totals:
+            lines += ["", "  %10s  %s" % ("value", "counter")]
+            for name, value in totals.items():
+                lines.append("  %10d  %s" % (value, name))
+        lines.append(line)
+        return "\n".join(lines)
+
+
+    def json (self):
+
+        """Report as a JSON document (text).
+        """
+
+        total = perf_counter() - self.start
+        return json.dumps({
+            "total": total,
+            "stages": [{"name": name, "calls": calls, "seconds": seconds, "blocks": blocks,
+                        "depth": depth}
+                       for name, calls, seconds, blocks, depth in self.stages()],
+            "counters": self.totals(),
+            "events": [{"name": name, "start": start - self.start, "duration": duration,
+                        "blocks": blocks, "pid": pid, "depth": depth, "args": args}
+                       for name, start, duration, blocks, pid, depth, args in self.events],
+        }, indent=2)
+
+
+    def trace (self):
+
+        """Chrome trace event format (text), for chrome://tracing or Perfetto.
+        Stages are complete events ("X") and counters are counter events ("C").
+        """
+
+        us = 1e6
+        events = []
+        for name, start, duration, blocks, pid, depth, args in self.events:
+            args = dict(args, blocks=blocks)
+            events.append({"name": name, "cat": "stage", "ph": "X", "pid": pid, "tid": pid,
+                           "ts": (start - self.start) * us, "dur": duration * us, "args": args})
+        for name, value, time, pid in self.counters:
+            events.append({"name": name, "cat": "counter", "ph": "C", "pid": pid, "tid": pid,
+                           "ts": (time - self.start) * us, "args": {name: value}})
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+
+    def write (self, format="table", output=None):
+
+        """Writes the report as <format> ("table", "json" or "trace")
+        to <output> (file name), stderr by default.
+        """
+
+        text = {"table": self.table, "json": self.json, "trace": self.trace}[format]()
+        if output is None:
+            print (text, file=sys.stderr)
+        else:
+            with open(output, "w") as f:
+                f.write(text + "\n")
+
+
+class Stage:
+
+    """Context manager of a stage, records its event in the report on exit.
+    """
+
+    __slots__ = ("report", "name", "args", "start", "blocks")
+
+    def __init__ (self, report, name, args):
+
+        self.report = report
+        self.name = name
+        self.args = args
+
+    def __enter__ (self):
+
+        self.report.depth += 1
+        self.blocks = sys.getallocatedblocks()
+        self.start = perf_counter()
+        return self
+
+    def __exit__ (self, *exc):
+
+        end = perf_counter()
+        report = self.report
+        report.depth -= 1
+        report.events.append((self.name, self.start, end - self.start,
+                              sys.getallocatedblocks() - self.blocks, report.pid,
+                              report.depth, self.args))
+        return False
+
+
+class Disabled:
+
+    """Stage when instrumentation is disabled.
+    """
+
+    __slots__ = ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        return False
+
+
+#--------------------------------------------------------------------------------------------
+
+
+report = None # Report of this process, None if disabled
+disabled = Disabled()
+
+
+def enable ():
+
+    """Starts recording, a new Report. Return it.
+    """
+
+    global report
+    report = Report()
+    return report
+
+
+def disable ():
+
+    global report
+    report = None
+
+
+def enabled ():
+
+    return report is not None
+
+
+def stage (name, **args):
+
+    """Context manager, records the wall time and allocated blocks of the code
+    in it as the stage <name>. <args> -- details (file...), JSON values
+    """
+
+    if report is None:
+        return disabled
+    return report.stage(name, **args)
+
+
+def count (name, value=1):
+
+    """Adds <value> to the counter <name>.
+    """
+
+    if report is not None:
+        report.count(name, value)
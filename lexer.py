@@ -23,8 +23,7 @@
 import sys
 import re
 import os
-import time
-from statistics import mean 
+from array import array
 
 
 # REGEX. Regular expressions.
@@ -42,8 +41,26 @@ regex = re.compile('|'.join(
     "(?P<%s>%s)" % t for t in rules))
 
 
+# Stream mode. Same rules, but newlines and tabs are the real characters
+# instead of the escaped "\\n" and "\\t" written by main.py and --in.
+
+stream_rules = (
+    ('stmt', r'\n\t|\n|\t'),
+    ('other',r'[^\S\n\t]+|;')) + rules[2:]
+
+stream_regex = re.compile('|'.join(
+    "(?P<%s>%s)" % t for t in stream_rules))
+
+CHUNK_SIZE = 64*1024 # characters read from the file on each call
+BATCH = 4096 # lexemes generated at once by stream_lexemes
+
+escapes = {"\n": "\\n", "\t": "\\t"}
+
+
 class Token():
 
+    __slots__ = ("id", "value", "pos")
+
     def __init__(self, id, value, pos):
         self.id = id
         self.value = value
@@ -64,12 +81,124 @@ class StrError(Exception):
 
 
 
-def lexer (program):
+# SCANNER. Hand-written alternative to <regex>, same tokens.
+# Dispatch on the first character of the token through a table {char: (rule, scan)}
+# instead of trying every group of the alternation. <scan> is the length of a fixed
+# length token or the match method of a small anchored pattern for that rule only
+# (names, numbers and spaces are matched in C, no Python call per character).
+
+operators = (":","=","+","-","*","%","/","^","<",">","(",")","&","!","}","{","[","]","|",",",".","@")
+operators2 = ("<=",">=","<<",">>","!=","==",":=","<>","::","<-","->","**")
+
+scan_stmt = re.compile(r'\\n\\t|\\n|\\t').match
+scan_newline = re.compile(r'\n\t?').match
+scan_space = re.compile(r'\s+').match
+scan_blank = re.compile(r'[^\S\n\t]+').match # stream mode, spaces but not newlines or tabs
+scan_name = re.compile(r'[\w_]+').match # the first character is a letter or _
+scan_number = re.compile(r'\d+(\.\d+)?').match # as (:?\d*\.)?\d+ from a digit
+# strings and comments, with the same backtracking as the regex: one or more
+# quotes, at least one character and the closing quote
+scan_string = re.compile(r'"+[\s\S]+?"').match
+scan_cmt = re.compile(r'#+[\s\S]+?#').match
+
+
+def operator_scanner (c):
+
+    """scan for operators starting with <c>, one or two characters.
+    Operators that can not be followed by a second character are fixed length (1).
+    """
+
+    seconds = "".join(op[1] for op in operators2 if op[0] == c)
+    if not seconds: return 1
+    return re.compile(re.escape(c) + "[" + re.escape(seconds) + "]?").match
+
+
+dispatch = {}
+dispatch["\\"] = ("stmt", scan_stmt)
+dispatch[";"] = ("other", 1)
+for c in " \t\n\r\f\v\x1c\x1d\x1e\x1f\x85": dispatch[c] = ("other", scan_space)
+for c in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_": dispatch[c] = ("Name", scan_name)
+for c in operators: dispatch[c] = ("operator", operator_scanner(c))
+for c in "0123456789": dispatch[c] = ("number", scan_number)
+dispatch['"'] = ("string", scan_string)
+dispatch["#"] = ("cmt", scan_cmt)
+
+# stream mode: real newlines and tabs, no escaped ones
+stream_dispatch = dict(dispatch)
+del stream_dispatch["\\"]
+for c in " \r\f\v\x1c\x1d\x1e\x1f\x85": stream_dispatch[c] = ("other", scan_blank)
+stream_dispatch["\n"] = ("stmt", scan_newline)
+stream_dispatch["\t"] = ("stmt", 1)
+
+
+def lookup (c, table=dispatch):
+
+    """Rule for a character out of <table>: unicode spaces and digits.
+    Return (rule, scan) or (None, None) if no rule starts with <c>.
+    """
+
+    if c.isspace():
+        return "other", (scan_space if table is dispatch else scan_blank)
+    if c.isdecimal():
+        return "number", scan_number
+    return None, None
+
+
+def scan (text, i, table=dispatch):
+
+    """Scans the token starting at <text>[i]. Return (rule, end) or None.
+    """
+
+    try:
+        name, fn = table[text[i]]
+    except KeyError:
+        name, fn = lookup(text[i], table)
+        if name is None: return None
+    if fn.__class__ is int: return name, i+fn
+    t = fn(text, i)
+    return t and (name, t.end())
+
+
+def error_handling (text, i, base=0):
+
+    """Shows the line of <text> with the error and raises the exception.
+    <base> -- offset of text[0] in the source (stream mode).
+    """
+
+    line = text.rfind("\n", 0, i) + 1
+    pointer = text[line:i+1]+"\n"+("-"*(i-line))+"^"
+    print (pointer)
+
+    if text[i] == "#" :
+        raise CmtError("Comment Error.Start comment at position %d but missing enclose # " % (base+i+1))
+    if text[i] == '"' :
+        raise StrError('String Error.Start string at position %d but missing enclose "' % (base+i+1))
+    else:
+        raise TokenError("Unexpected character at position %d: `%s`" % (base+i+1, text[i]))
+
+
+engines = ("regex", "scan")
+
+
+def lexer (program, engine="regex"):
 
     """Generator. Generate instance(Token).See token_list and debugging comments.
     Using generators.
+    If <program> is a file object the source is read in chunks, see stream_lexer.
+    <engine> -- "regex" (one alternation regex) or "scan" (hand-written scanner)
     """
 
+    if engine not in engines:
+        raise ValueError("Unknown lexer engine %r" % engine)
+
+    if hasattr(program, "read"):
+        yield from stream_lexer(program, engine=engine)
+        return
+
+    if engine == "scan":
+        yield from scan_lexer(program)
+        return
+
     module = Token("Module", "Module", -1)
     
     yield module
@@ -77,27 +206,14 @@ def lexer (program):
     #token_list.append(module) #only for debugging
     
     i = 0
-
-    def error_handling ():
-        # !!! modificar, añadir linea y corregir la cadena de salida
-
-        pointer = program[:i+1]+"\n"+("-"*(len(program[:i+1])-1))+"^"
-        print (pointer)
-
-        if program[i] == "#" :
-            raise CmtError("Comment Error.Start comment at position %d but missing enclose # " % (i+1))
-        if program[i] == '"' : 
-            raise StrError('String Error.Start string at position %d but missing enclose "' % (i+1))
-        else: 
-            raise TokenError("Unexpected character at position %d: `%s`" % (i+1, program[i]))
-
+    pos = -1
 
     for t in regex.finditer(program):
        
         pos = t.start()
         
         if pos > i:
-            error_handling()
+            error_handling(program, i)
 
         i = t.end()
         name = t.lastgroup
@@ -112,13 +228,334 @@ def lexer (program):
         #token_list.append(token) #only for debugging
 
     if i < len(program):
-        error_handling()
+        error_handling(program, i)
 
     end = Token("(end)", "(end)", pos+1)
     
     yield end 
     #token_list.append(end) #only for debugging
-    return token_list #only for debugging
+    #return token_list #only for debugging
+
+
+def scan_lexer (program):
+
+    """Generator. Same tokens as lexer(program) using the hand-written scanner,
+    one pass over <program> without the regex alternation.
+    """
+
+    yield Token("Module", "Module", -1)
+
+    i = 0
+    pos = -1
+    n = len(program)
+    table = dispatch
+
+    while i < n:
+
+        try:
+            name, scan = table[program[i]]
+        except KeyError:
+            name, scan = lookup(program[i])
+            if name is None: error_handling(program, i)
+
+        if scan.__class__ is int:
+            end = i+scan
+        else:
+            t = scan(program, i)
+            if t is None: error_handling(program, i)
+            end = t.end()
+
+        pos = i
+        if name != "other" and name != "cmt":
+            yield Token(name, program[i:end], i)
+        i = end
+
+    yield Token("(end)", "(end)", pos+1)
+
+
+# COMPACT TOKENS
+
+token_kinds = ("Module", "stmt", "Name", "operator", "number", "string", "(end)")
+kind_codes = {"other": None, "cmt": None} # skipped
+for code, kind in enumerate(token_kinds): kind_codes[kind] = code
+
+MODULE = kind_codes["Module"]
+END = kind_codes["(end)"]
+STMT = kind_codes["stmt"]
+STRING = kind_codes["string"]
+
+code_dispatch = dict((c, (kind_codes[name], scan)) for c, (name, scan) in dispatch.items())
+
+
+class TokenBuffer():
+
+    """Tokens of <program> as a struct of arrays, no Token object per lexeme:
+        kinds -- array('B'), index in <token_kinds>
+        starts, ends -- array('I'), offsets of the value in <program>
+    Values are sliced from the source only when needed, see value(i).
+    Same tokens (and errors) as lexer(program, engine). The parser reads it
+    directly, see sqyparser.tokenize.
+    If <program> is a file object it is lexed in chunks of <chunk_size> like
+    stream_lexer (real newlines and tabs, as the parser reads a file): the arrays are
+    filled from the offsets of each chunk, and <source> keeps the text read. The values
+    of stmt and string are escaped when read (<escaped>), see escape.
+    """
+
+    __slots__ = ("source", "kinds", "starts", "ends", "escaped")
+
+    def __init__ (self, program, engine="regex", chunk_size=CHUNK_SIZE):
+
+        if engine not in engines:
+            raise ValueError("Unknown lexer engine %r" % engine)
+
+        self.source = program
+        self.escaped = False
+        self.kinds = array('B', [MODULE])
+        self.starts = array('I', [0])
+        self.ends = array('I', [0])
+
+        if hasattr(program, "read"): self._stream(program, engine, chunk_size)
+        elif engine == "scan": self._scan(program)
+        else: self._regex(program)
+
+    def _regex (self, program):
+        kinds, starts, ends = self.kinds, self.starts, self.ends
+        i = 0
+        pos = -1
+        for t in regex.finditer(program):
+            pos = t.start()
+            if pos > i:
+                error_handling(program, i)
+            i = t.end()
+            code = kind_codes[t.lastgroup]
+            if code is not None:
+                kinds.append(code); starts.append(pos); ends.append(i)
+        if i < len(program):
+            error_handling(program, i)
+        self._end(pos+1)
+
+    def _scan (self, program):
+        kinds, starts, ends = self.kinds, self.starts, self.ends
+        table = code_dispatch
+        i = 0
+        pos = -1
+        n = len(program)
+        while i < n:
+            try:
+                code, scan = table[program[i]]
+            except KeyError:
+                name, scan = lookup(program[i])
+                if name is None: error_handling(program, i)
+                code = kind_codes[name]
+            if scan.__class__ is int:
+                end = i+scan
+            else:
+                t = scan(program, i)
+                if t is None: error_handling(program, i)
+                end = t.end()
+            pos = i
+            if code is not None:
+                kinds.append(code); starts.append(i); ends.append(end)
+            i = end
+        self._end(pos+1)
+
+    def _stream (self, stream, engine, chunk_size):
+        kinds, starts, ends = self.kinds, self.starts, self.ends
+        pieces = [] # text read
+        def read (size):
+            chunk = stream.read(size)
+            pieces.append(chunk)
+            return chunk
+        pos = -1
+        for buf, base, lexemes in stream_lexemes(read, chunk_size, engine):
+            for name, start, end in lexemes:
+                code = kind_codes[name]
+                if code is not None:
+                    kinds.append(code); starts.append(base + start); ends.append(base + end)
+            if lexemes:
+                pos = base + lexemes[-1][1]
+        self.source = "".join(pieces)
+        self.escaped = True
+        self._end(pos+1)
+
+    def _end (self, pos):
+        self.kinds.append(END); self.starts.append(pos); self.ends.append(pos)
+
+    def __len__ (self):
+        return len(self.kinds)
+
+    def id (self, i):
+        return token_kinds[self.kinds[i]]
+
+    def value (self, i):
+        kind = self.kinds[i]
+        if kind == MODULE or kind == END: return token_kinds[kind]
+        value = self.source[self.starts[i]:self.ends[i]]
+        if self.escaped and (kind == STMT or kind == STRING): value = escape(value)
+        return value
+
+    def items (self):
+        """Generator. (id, value) of each token."""
+        source = self.source
+        escaped = self.escaped
+        for kind, start, end in zip(self.kinds, self.starts, self.ends):
+            if kind == MODULE or kind == END:
+                yield token_kinds[kind], token_kinds[kind]
+            elif escaped and (kind == STMT or kind == STRING):
+                yield token_kinds[kind], escape(source[start:end])
+            else:
+                yield token_kinds[kind], source[start:end]
+
+    def __getitem__ (self, i):
+        pos = -1 if self.kinds[i] == MODULE else self.starts[i]
+        return Token(self.id(i), self.value(i), pos)
+
+    def __iter__ (self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__ (self):
+        return "TokenBuffer(%d tokens)" % len(self)
+
+
+def tokens (program, engine="regex"):
+
+    """Compact tokens of <program>, see TokenBuffer.
+    """
+
+    return TokenBuffer(program, engine)
+
+
+def escape (value):
+
+    """Value of a stmt or string token of the stream: real newlines and tabs as the
+    escaped "\\n" and "\\t" of the other sources, the parser does not change.
+    """
+
+    for c in escapes:
+        value = value.replace(c, escapes[c])
+    return value
+
+
+def stream_lexer (stream, chunk_size=CHUNK_SIZE, engine="regex"):
+
+    """Generator. Same tokens as lexer(program) but reading <stream> in chunks of
+    <chunk_size> characters, so the whole source is never in memory.
+    Real newlines and tabs are recognized, no need to replace them with "\\n" and "\\t"
+    before lexing. Token values are the escaped ones, the parser does not change.
+    Positions are offsets in the real source. See stream_lexemes.
+    """
+
+    yield Token("Module", "Module", -1)
+
+    pos = -1
+    for buf, base, lexemes in stream_lexemes(stream.read, chunk_size, engine):
+        for name, start, end in lexemes:
+            if name == "other" or name == "cmt":
+                continue
+            value = buf[start:end]
+            if name == "stmt" or name == "string":
+                value = escape(value)
+            yield Token(name, value, base + start)
+        if lexemes:
+            pos = base + lexemes[-1][1]
+
+    yield Token("(end)", "(end)", pos+1)
+
+
+def stream_lexemes (read, chunk_size=CHUNK_SIZE, engine="regex"):
+
+    """Generator. Lexemes of the source read with read(size), in chunks of
+    <chunk_size> characters: (buf, base, lexemes), <lexemes> a list of at most
+    BATCH (rule, start, end) of the text buffered now <buf>, spaces and comments too.
+    <base> -- offset of buf[0] in the source.
+
+    A lexeme is only accepted when the buffer holds enough text after it to be sure
+    it does not continue in the next chunk (names, numbers, "\\n\\t", strings and
+    comments split between two chunks). Reads grow with the text not accepted yet,
+    so long strings and comments are not scanned again and again.
+    The lexemes before an error are generated, then the error is raised.
+    """
+
+    buf = ""
+    base = 0 # offset of buf[0] in the source
+    i = 0
+    eof = False
+    table = stream_dispatch
+
+    while True:
+
+        if not eof:
+            chunk = read(max(chunk_size, len(buf) - i))
+            if chunk:
+                buf = buf[i:] + chunk
+                base += i
+                i = 0
+            else:
+                eof = True
+        n = len(buf)
+        last = n - 1 # a token ending here may go on
+        lexemes = []
+
+        if engine == "scan":
+            while i < n:
+                try:
+                    name, scan = table[buf[i]]
+                except KeyError:
+                    name, scan = lookup(buf[i], table)
+                    if name is None: break
+                if scan.__class__ is int:
+                    end = i+scan
+                else:
+                    t = scan(buf, i)
+                    if t is None: break
+                    end = t.end()
+                if not eof and (end >= last or ((name == "string" or name == "cmt")
+                                                and partial_quoted(buf, i))):
+                    break
+                lexemes.append((name, i, end))
+                i = end
+                if len(lexemes) == BATCH:
+                    yield buf, base, lexemes
+                    lexemes = []
+        else:
+            for t in stream_regex.finditer(buf, i):
+                if t.start() != i: break
+                name = t.lastgroup
+                end = t.end()
+                if not eof and (end >= last or ((name == "string" or name == "cmt")
+                                                and partial_quoted(buf, i))):
+                    break
+                lexemes.append((name, i, end))
+                i = end
+                if len(lexemes) == BATCH:
+                    yield buf, base, lexemes
+                    lexemes = []
+
+        yield buf, base, lexemes
+
+        if i >= n:
+            if eof: return
+        elif eof or buf[i] not in '"#' and not lexemes_at(buf, i, engine):
+            error_handling(buf, i, base)
+
+
+def lexemes_at (buf, i, engine):
+
+    # a token starts at buf[i] (the end of the buffer, not accepted yet)
+    if engine == "scan":
+        return scan(buf, i, stream_dispatch) is not None
+    return stream_regex.match(buf, i) is not None
+
+
+def partial_quoted (buf, i):
+
+    # the string or comment at buf[i] may end after the buffer: the quotes
+    # and at least one character are not followed by a closing quote
+    q = buf[i]
+    j = i
+    while j < len(buf) and buf[j] == q: j += 1
+    return buf.find(q, j+1) < 0
 
 
 def console ():
@@ -129,71 +566,113 @@ def console ():
         clear
     """
 
-    try:
-        while True:
+    while True:
 
+        try:
             expr = input (">> ")
-            
-            if expr == "exit": exit()
-            if expr == "clear": 
-                os.system('clear')
-                console()
-            print (lexer(expr))
-
-    except SyntaxError:
-        print ("ERROR")
-        console()
+        except EOFError:
+            print ()
+            return
+        
+        if expr == "exit": exit()
+        if expr == "clear": 
+            os.system('clear')
+            continue
+        try:
+            print (list(lexer(expr)))
+        except (TokenError, CmtError, StrError, SyntaxError):
+            print ("ERROR")
 
 
-if "--console" in sys.argv:
+def main():
 
-    print ("Squanchy PL Lexer Test")
-    print ("v1.0\n")
-    console()
+    if "--console" in sys.argv:
 
+        print ("Squanchy PL Lexer Test")
+        print ("v1.0\n")
+        console()
 
-if "--test" in sys.argv:
 
-    """Benchmark. SQY Lexer vs Python's tokenize module.
-    Same code written in SQY and Python: <code.txt> <code_py.txt>
-    """
-    maxSize = 200000
-    difSize = 2000
-    iterations = int(maxSize / difSize)
-    
-    program0 = '+1+1+1+1+1'
-
-    measureSQY = []
-    measurePY = []
-    program = program0
-    for i in range(iterations):
-        measureSQY.append([])
-        measurePY.append([])
-
-        progfile = open("code_py.txt","w")
-        progfile.write(program)
-        for j in range(1000):
-            #Squanchy
-            start = time.time()
-            print (lexer(program)) # real result with:  print(lexer(program))
-            #lexer(program)
-            end = time.time()
-            measureSQY[i].append(end-start)
-
-            #Python
-            start = time.time()
-            os.system("python -m tokenize code_py.txt")
-            end = time.time()
-            measurePY[i].append(float(end-start))
-
-
-        program = program0 * (i+1)
-
-    sqy_time = list(map(lambda x: mean(x), measureSQY))
-    py_time = list(map(lambda x: mean(x), measurePY))
-
-    # compare times
-    print ("sqy time >>",sqy_time)
-    print ("py time >>",py_time)
-    print ("how better? =", list(map(lambda x,y: float(x/y), py_time, sqy_time)),"times")
-    exit()
+    # stream chunk sizes of parity: tokens split between chunks
+    chunk_sizes = (1, 2, 3, 7, 64, CHUNK_SIZE)
+
+    def parity (program):
+
+        """Tokens of <program> with every engine, string, stream and TokenBuffer input,
+        the streams read in chunks of every <chunk_sizes>.
+        Return the list of engines whose output differs from lexer(program).
+        """
+
+        import io
+        import contextlib
+
+        def tokens (program, engine, compact=False, chunk_size=CHUNK_SIZE):
+            out = []
+            try:
+                with contextlib.redirect_stdout(io.StringIO()): # error pointer
+                    if isinstance(program, str):
+                        source = TokenBuffer(program, engine) if compact else lexer(program, engine)
+                    elif compact:
+                        source = TokenBuffer(program, engine, chunk_size)
+                    else:
+                        source = stream_lexer(program, chunk_size, engine)
+                    for t in source:
+                        out.append((t.id, t.value, t.pos))
+            except (TokenError, CmtError, StrError) as e:
+                return [(type(e).__name__, e.args[0])]
+            return out
+
+        escaped = program.replace("\n","\\n").replace("\t","\\t")
+        expected = tokens(escaped, "regex")
+        expected_stream = tokens(io.StringIO(program), "regex")
+
+        failed = []
+        for engine in engines:
+            if tokens(escaped, engine) != expected:
+                failed.append(engine)
+            if tokens(escaped, engine, compact=True) != expected:
+                failed.append(engine + " (TokenBuffer)")
+            for size in chunk_sizes:
+                if tokens(io.StringIO(program), engine, False, size) != expected_stream:
+                    failed.append("%s (stream, chunks of %d)" % (engine, size))
+                if tokens(io.StringIO(program), engine, True, size) != expected_stream:
+                    failed.append("%s (stream TokenBuffer, chunks of %d)" % (engine, size))
+        return failed
+
+
+    if "--parity" in sys.argv:
+
+        """Test. Same tokens with every engine, see parity().
+        Sample files and random programs, short ones and some longer than
+        the small chunks.
+        """
+
+        import random
+
+        programs = []
+        for filename in ("test.sqy", "code.sqy"):
+            with open(filename) as f:
+                programs.append(f.read())
+
+        alphabet = list('ab_19. \t\n;"#:<=>-*+()[],$é٣\u00a0') + ['\\n','\\t','"""','##']
+        random.seed(0)
+        for i in range(5000):
+            size = random.randint(0, 30)
+            programs.append("".join(random.choice(alphabet) for j in range(size)))
+        for i in range(200):
+            size = random.randint(60, 300)
+            programs.append("".join(random.choice(alphabet) for j in range(size)))
+
+        errors = 0
+        for program in programs:
+            failed = parity(program)
+            if failed:
+                errors += 1
+                print ("FAIL", failed, repr(program))
+
+        print ("parity: %d programs, %d failed" % (len(programs), errors))
+        exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
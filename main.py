@@ -16,63 +16,422 @@
 #-------------------------------------------------------------------------------
 
 
-import llvmlite.ir as ir
-import llvmlite.binding as llvm
-from sqyparser import ast
+from sqyparser import Parser
 from codegen import CodeGen
+from cache import ObjectCache, digest
+from session import Session
+import repl
+from optimizer import fold, walk
+from lexer import tokens, engines
+import vm
+import instrument
 import myeval as e
+import io
 import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def console ():
+def console (session=None):
+
+    """Interactive console. Every line is added to the same <session>
+    (session.Session), only the new statements are parsed.
+    """
+
+    if session is None: session = Session(name="console") # same scope for every line
+
+    while True:
+        try:
+            expr = input (">> ")
+        except EOFError:
+            print ()
+            return
+        if expr == "exit": exit()
+        if expr == "clear":
+            os.system('clear')
+            continue
+
+        try:
+            for unit in session.append(expr):
+                for tree in unit.nodes:
+                    print (tree)
+                    print (session.scope)
+                    print (e.Eval(tree,session.scope))
+        except Exception as error:
+            print (error.args[0] if error.args else error)
+
+
+
+#--------------------------------------------------------------------------------------------
+# COMPILER DRIVER
+#
+# python main.py [files.sqy ...] [-o output] [-j jobs] [-O0..-O3]
+#
+# Every file is lexed, parsed, translated to LLVM IR and compiled to an object
+# file (in process, CodeGen.emit_object) in a process pool, then all the objects
+# are linked together once. The linker is the only external tool.
+# With several files the top level code of each one goes to its own entry
+# function, and a startup module calls them in order from main.
+# Each file is a unit compiled on its own (in parallel, cached by its text): its
+# functions and names are its own, a file cannot call the functions of other
+# files (error, see unit_error).
+#
+# python main.py --jit [files.sqy ...]
+#
+# Runs the program in process with the MCJIT engine of CodeGen, nothing written.
+#
+# python main.py --interpret [files.sqy ...]
+#
+# Runs the program in the bytecode VM (vm.py), no LLVM at all.
+#
+# python main.py --repl [--jit]
+#
+# Interactive console, tree interpreter or native code (repl.py).
+#
+# The object code is kept in a cache (cache.ObjectCache, ~/.cache/squanchy),
+# unchanged sources are not lexed, parsed or compiled again. --no-cache disables it.
+#
+# python main.py --engine scan ...
+#
+# Lexes with the hand-written scanner instead of the regex (lexer.engines), same tokens.
+#
+# python main.py --time-report[=table|json|trace] [--time-report-file FILE] ...
+#
+# Time, allocated memory blocks and counters of each stage, see instrument.py.
+
+
+class BuildError(Exception):
+    pass
+
+
+def options (fold_constants):
+
+    """Front end options for CodeGen (cache key).
+    """
+
+    return () if fold_constants else ("no-fold",)
+
+
+def front_end (source, path, fold_constants=True, engine="regex"):
+
+    """Tree and scope of <source> (text or file), folded if <fold_constants>.
+    The text is the content of the file <path>: lexed as a file (real newlines
+    end the statements), see lexer.stream_lexer.
+    With instrumentation the tokens are read first (lexer.TokenBuffer, same
+    stream lexer) to time the lexer apart; else the parser pulls them from the lexer.
+    Equal Const and Name nodes are shared, see Parser(intern=...).
+    <engine> -- lexer engine, see lexer.lexer (same tokens)
+    """
+
+    if isinstance(source, str):
+        source = io.StringIO(source)
+    if instrument.enabled():
+        with instrument.stage("lexer", file=path):
+            source = tokens(source, engine)
+        instrument.count("tokens", len(source))
+
+    with instrument.stage("parser", file=path):
+        tree,scope = Parser(engine=engine, intern="leaves").ast(source)
+    if fold_constants:
+        with instrument.stage("fold", file=path):
+            tree = fold(tree)
+
+    if instrument.enabled():
+        instrument.count("AST nodes", sum(1 for node in walk(tree.first)))
+    return tree,scope
+
+
+def defined_functions (path):
+
+    """Names of the functions defined at the top level of the file <path>,
+    empty if it does not parse.
+    """
+
+    try:
+        with open(path) as f:
+            tree,scope = front_end(f, path, False)
+    except Exception:
+        return set()
+    return {node.first.value for node in tree.first or [] if node.id == "Function"}
+
+
+def unit_error (files, path, error):
+
+    """BuildError of the file <path> of the program <files> that failed with <error>.
+    A call to a function of other file is reported as such, the files are compiled apart.
+    """
+
+    name = getattr(error, "function", None)
+    if name is not None:
+        for other in files:
+            if other != path and name in defined_functions(other):
+                return BuildError('%s: function "%s" is defined in %s, a file cannot call'
+                                  ' the functions of other files' % (path, name, other))
+    return BuildError("%s: %s" % (path, error))
+
+
+def compile_unit (path, entry="main", verbose=False, opt_level=0, cache=None, fold_constants=True,
+                  engine="regex"):
+
+    """Lexes, parses, generates the LLVM IR of the file <path> and compiles it.
+    Runs in the worker processes. Return the object code (bytes).
+    <entry> -- name of the function with the top level code of the file
+    <opt_level> -- 0..3, see CodeGen.optimize
+    <cache> -- ObjectCache, the object code of an unchanged file comes from it
+    <fold_constants> -- run the AST optimizer, see optimizer.fold
+    <engine> -- lexer engine, see lexer.lexer
+    """
+
+    if cache is None:
+        codegen = CodeGen(name=path, entry=entry, opt_level=opt_level)
+    else:
+        with open(path, "rb") as f:
+            source = digest(f) # in chunks
+        codegen = CodeGen(name=path, entry=entry, opt_level=opt_level, cache=cache, source=source,
+                          options=options(fold_constants))
+        if codegen.cached():
+            if verbose:
+                print ("\n",path,"(cached)")
+            return codegen.emit_object()
+    with open(path) as f:
+        tree,scope = front_end(f, path, fold_constants, engine) # streaming lexer, see lexer.stream_lexer
+
+    if verbose:
+        print ("\n",path,"\n",tree)
+        print ("\n",scope,"\n")
+
+    codegen.generate(tree, scope)
+    obj = codegen.emit_object()
+    if verbose:
+        print (codegen.optimized_ir() if opt_level else codegen.module)
+    return obj
+
+
+def instrumented (function, *args):
+
+    """Runs <function> (in a worker process) with its own instrumentation report.
+    Return (result, Report.dump()), see instrument.Report.merge.
+    """
+
+    report = instrument.enable()
+    try:
+        return function(*args), report.dump()
+    finally:
+        instrument.disable()
+
+
+def startup_object (entries, opt_level=0, cache=None):
+
+    """Object code of the main function calling every <entries> function in order,
+    it returns 0.
+    """
+
+    codegen = CodeGen(name="startup", opt_level=opt_level, cache=cache,
+                      source=digest(" ".join(entries)))
+    if codegen.cached():
+        return codegen.emit_object()
+    codegen.call_entries(entries)
+    return codegen.emit_object()
+
+
+def jit (files, verbose=False, opt_level=0, cache=None, fold_constants=True, engine="regex"):
+
+    """Compiles the Squanchy <files> in memory and runs them in process,
+    one after another (no object files, no linker).
+    <cache> -- ObjectCache, hooked to the MCJIT engine
+    """
+
+    for path in files:
+        try:
+            with open(path, "rb") as f:
+                source = digest(f) # in chunks
+            codegen = CodeGen(name=path, opt_level=opt_level, cache=cache, source=source,
+                              options=options(fold_constants))
+            if codegen.cached("jit"):
+                if verbose:
+                    print ("\n",path,"(cached)")
+                with instrument.stage("run", file=path):
+                    codegen.run()
+                continue
+            with open(path) as f:
+                tree,scope = front_end(f, path, fold_constants, engine)
+            codegen.generate(tree, scope)
+            if verbose:
+                print (codegen.optimized_ir() if opt_level else codegen.module)
+        except Exception as error:
+            raise unit_error(files, path, error)
+        with instrument.stage("run", file=path):
+            codegen.run()
+
+
+def interpret (files, fold_constants=True, engine="regex"):
+
+    """Runs the Squanchy <files> one after another in the bytecode VM.
+    """
+
+    for path in files:
+        try:
+            with open(path) as f:
+                tree,scope = front_end(f, path, fold_constants, engine)
+            with instrument.stage("bytecode", file=path):
+                code = vm.Compiler().compile(tree)
+            instrument.count("bytecode instructions", len(code.code) // 2)
+            with instrument.stage("run", file=path):
+                vm.run(code)
+        except Exception as error:
+            raise BuildError("%s: %s" % (path, error))
+
+
+def run (command):
+
+    """Runs the external tool <command> (list), raise BuildError if it fails.
+    """
+
+    try:
+        subprocess.run(command, check=True)
+    except FileNotFoundError:
+        raise BuildError("%s not found" % command[0])
+    except subprocess.CalledProcessError as error:
+        raise BuildError("%s failed (exit status %d)" % (command[0], error.returncode))
+
+
+def build (files, output="output", jobs=None, build_dir=None, cc=None, verbose=False, opt_level=0,
+           cache=None, fold_constants=True, engine="regex"):
+
+    """Compiles the Squanchy <files> into the executable <output>.
+    jobs -- worker processes, os.cpu_count() by default
+    build_dir -- where the .o files are written, temporary by default
+    cc -- linker, $CC or clang by default
+    opt_level -- 0..3 like -O0..-O3
+    cache -- ObjectCache, None to compile every file
+    fold_constants -- constant folding on the AST, see optimizer.fold
+    engine -- lexer engine, see lexer.lexer
+    """
+
+    cc = cc or os.environ.get("CC", "clang")
+    if len(files) == 1:
+        entries = ["main"]
+    else:
+        entries = ["__sqy_main_%d" % i for i in range(len(files))]
+
+    tmp = None
+    if build_dir is None:
+        tmp = build_dir = tempfile.mkdtemp(prefix="sqy-")
+    else:
+        os.makedirs(build_dir, exist_ok=True)
 
     try:
-	    while True:
-	        expr = input (">> ")
-	        if expr == "exit": exit()
-	        if expr == "clear": 
-	            os.system('clear')
-	            console()
-	        
-	        program,scope = ast(expr)
-	        tree = program.first[0]
-	        print (tree)
-	        print (scope)
-	        print (e.Eval(tree,scope))
+        objects = [None] * len(files)
+
+        def submit (function, *args):
+            if instrument.enabled():
+                return pool.submit(instrumented, function, *args)
+            return pool.submit(function, *args)
 
-    except Exception as e:
-        print (e.args[0])
-        console()
+        def result (future):
+            if instrument.enabled():
+                result, dump = future.result()
+                instrument.report.merge(dump)
+                return result
+            return future.result()
 
+        with instrument.stage("compile"), ProcessPoolExecutor(jobs) as pool:
 
+            units = {}
+            for i, (path, entry) in enumerate(zip(files, entries)):
+                unit = submit(compile_unit, path, entry, verbose, opt_level, cache, fold_constants,
+                              engine)
+                units[unit] = i
+            if len(files) > 1:
+                startup = submit(startup_object, entries, opt_level, cache)
 
-f = open("test.sqy")
-program = f.read()
-f.close()
-program = program.replace("\n","\\n").replace("\t","\\t")
+            for unit in as_completed(units):
+                i = units[unit]
+                path = files[i]
+                try:
+                    obj = result(unit)
+                except Exception as error:
+                    raise unit_error(files, path, error)
 
-tree,scope = ast(program)
-print ("\n",tree)
-print ("\n",scope,"\n")
+                name = "%d_%s.o" % (i, os.path.splitext(os.path.basename(path))[0])
+                objects[i] = os.path.join(build_dir, name)
+                with open(objects[i], "wb") as f:
+                    f.write(obj)
 
-#console()
+            if len(files) > 1:
+                objects.append(os.path.join(build_dir, "startup.o"))
+                with open(objects[-1], "wb") as f:
+                    f.write(result(startup))
 
-codegen = CodeGen()
+        # single link
+        with instrument.stage("link"):
+            run([cc] + objects + ["-o", output])
 
-module = codegen.module
-builder = codegen.builder
-printf = codegen.printf
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
 
-for i in tree.first:
-	#print (">>", i)
-	e.Eval(i,scope,builder,module,printf)
 
+def main (argv=None):
+
+    parser = argparse.ArgumentParser(description="Squanchy compiler")
+    parser.add_argument("files", nargs="*", default=["test.sqy"],
+                        help="Squanchy sources (.sqy), run in order. Each file is compiled on its"
+                        " own: it cannot call the functions of other files")
+    parser.add_argument("-o", "--output", default="output", help="executable (default: output)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="parallel jobs (default: CPUs)")
+    parser.add_argument("--build-dir", default=None, help="keep the .o files in this directory")
+    parser.add_argument("--cc", default=None, help="linker (default: $CC or clang)")
+    parser.add_argument("-O", dest="opt_level", type=int, default=0, choices=CodeGen.opt_levels,
+                        metavar="LEVEL", help="optimization level 0..3 (default: 0)")
+    parser.add_argument("--no-fold", action="store_true", help="do not fold the constants of the AST")
+    parser.add_argument("--engine", default="regex", choices=engines,
+                        help="lexer engine: regex or the hand-written scanner (default: regex)")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the compilation cache")
+    parser.add_argument("--cache-dir", default=None, help="compilation cache (default: ~/.cache/squanchy)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the AST, scope and IR")
+    parser.add_argument("--jit", action="store_true", help="run the program in process, do not build")
+    parser.add_argument("--interpret", action="store_true", help="run the program in the bytecode VM")
+    parser.add_argument("--repl", action="store_true",
+                        help="interactive console (with --jit: native code, see repl.py)")
+    parser.add_argument("--time-report", nargs="?", const="table", choices=("table", "json", "trace"),
+                        help="time and counters of each stage (stderr), as a table, JSON"
+                        " or Chrome trace events")
+    parser.add_argument("--time-report-file", default=None, metavar="FILE",
+                        help="write the --time-report to FILE")
+    args = parser.parse_args(argv)
+
+    if args.repl:
+        if args.jit:
+            repl.console(args.opt_level)
+        else:
+            console()
+        return
+
+    cache = None if args.no_cache else ObjectCache(args.cache_dir)
+    if args.time_report:
+        instrument.enable()
+
+    try:
+        if args.interpret:
+            interpret(args.files, not args.no_fold, args.engine)
+            return
+        if args.jit:
+            jit(args.files, args.verbose, args.opt_level, cache, not args.no_fold, args.engine)
+            return
+        build(args.files, args.output, args.jobs, args.build_dir, args.cc, args.verbose, args.opt_level,
+              cache, not args.no_fold, args.engine)
+    except BuildError as error:
+        print ("error:", error, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if instrument.enabled():
+            instrument.report.write(args.time_report, args.time_report_file)
 
-codegen.create_ir()
-codegen.save_ir("output.ll")
-tm = llvm.Target.from_default_triple().create_target_machine()
 
-os.system('llc -filetype=obj output.ll')
-os.system('clang output.o -o output')
-os.system('cat output.ll')
-#os.system('./output')
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -18,12 +18,116 @@
 
 import llvmlite.ir as ir
 import llvmlite.binding as llvm
-from ctypes import CFUNCTYPE
 import os
 import json
+from inference import BOOL, INT, FLOAT, literal, array
 
 
 i32_ty = ir.IntType(32)
+i1_ty = ir.IntType(1)
+i64_ty = ir.IntType(64)
+double_ty = ir.DoubleType()
+i8_ptr_ty = ir.IntType(8).as_pointer()
+
+
+def array_ty (ty):
+
+    """LLVM type of the arrays of elements of type <ty> (i64 or double):
+    {i64 length, ty* data}, the elements contiguous and never changed.
+    """
+
+    return ir.LiteralStructType([i64_ty, ty.as_pointer()])
+
+
+# type of inference -> LLVM type of its values
+llvm_types = {BOOL: i1_ty, INT: i64_ty, FLOAT: double_ty,
+              array(INT): array_ty(i64_ty), array(FLOAT): array_ty(double_ty)}
+
+element_size = 8 # bytes of an i64 or a double
+
+# operations of the interpreter mode, also used by optimizer.fold
+operations = {
+
+"+": lambda first,second: first+second,
+"-": lambda first,second: first-second,
+"not": lambda first,second: not first,
+"*": lambda first,second: first*second,
+"/": lambda first,second: divide(first, second),
+"%": lambda first,second: first%second,
+"**": lambda first,second: first**second,
+"and": lambda first,second: first and second,
+"or": lambda first,second: first or second,
+"!=": lambda first,second: first != second,
+"=": lambda first,second: first == second,
+"<": lambda first,second: first<second,
+">": lambda first,second: first>second,
+"<=": lambda first,second: first<=second,
+">=": lambda first,second: first >= second,
+}
+
+
+def divide (first, second):
+
+    # / of the generated code: fdiv, or sdiv of the ints (truncated to 0, exact)
+    if type(first) is float or type(second) is float:
+        return first / second
+    quotient = abs(first) // abs(second)
+    return quotient if (first < 0) == (second < 0) else -quotient
+
+
+unary_operations = {
+
+"+": lambda second: second,
+"-": lambda second: -second,
+"not": lambda second: not second,
+}
+
+# code generation of i64 (or i1) operands, (builder, first, second)
+codegen = {
+
+"+": lambda builder,first,second: builder.add(first, second),
+"-": lambda builder,first,second: builder.sub(first, second),
+"*": lambda builder,first,second: builder.mul(first, second),
+"/": lambda builder,first,second: builder.sdiv(first, second),
+"and": lambda builder,first,second: builder.and_(first, second),
+"or": lambda builder,first,second: builder.or_(first, second),
+"!=": lambda builder,first,second: builder.icmp_signed("!=",first,second),
+"=": lambda builder,first,second: builder.icmp_signed("==",first,second),
+"<": lambda builder,first,second: builder.icmp_signed("<",first,second),
+">": lambda builder,first,second: builder.icmp_signed(">",first,second),
+"<=": lambda builder,first,second: builder.icmp_signed("<=",first,second),
+">=": lambda builder,first,second: builder.icmp_signed(">=",first,second)
+}
+
+# code generation of double operands, "!=" is true for NaN as in C
+float_codegen = {
+
+"+": lambda builder,first,second: builder.fadd(first, second),
+"-": lambda builder,first,second: builder.fsub(first, second),
+"*": lambda builder,first,second: builder.fmul(first, second),
+"/": lambda builder,first,second: builder.fdiv(first, second),
+"!=": lambda builder,first,second: builder.fcmp_unordered("!=",first,second),
+"=": lambda builder,first,second: builder.fcmp_ordered("==",first,second),
+"<": lambda builder,first,second: builder.fcmp_ordered("<",first,second),
+">": lambda builder,first,second: builder.fcmp_ordered(">",first,second),
+"<=": lambda builder,first,second: builder.fcmp_ordered("<=",first,second),
+">=": lambda builder,first,second: builder.fcmp_ordered(">=",first,second)
+}
+
+unary_codegen = {
+
+"+": lambda builder,second: second,
+"-": lambda builder,second: builder.fneg(second) if second.type == double_ty
+                            else builder.neg(second),
+"not": lambda builder,second: builder.not_(second) if second.type == i1_ty
+                              else builder.fcmp_ordered("==", second, second.type(0))
+                              if second.type == double_ty
+                              else builder.icmp_signed("==", second, second.type(0)),
+}
+
+# a op b == b op a, see Evaluator.binary_ir
+commutative = frozenset(("+", "*", "and", "or", "=", "!="))
+
 
 def Eval(node, scope,builder = None,module= None,printf= None):
 
@@ -35,197 +139,991 @@ def Eval(node, scope,builder = None,module= None,printf= None):
         - 4+5 -> Eval(Add (Cont 4, Cont 5))
                     -> return 9 
                     -> return builder.add(4,5), wich generates
+    See Evaluator, to evaluate many nodes use one Evaluator.
     """
 
-    codegen = {
-    
-    "+": lambda first,second: builder.add(first, second),
-    "-": lambda first,second: builder.sub(first, second),
-    "not": lambda first,second: builder.not_(first),
-    "*": lambda first,second: builder.mul(first, second),
-    "/": lambda first,second: builder.sdiv(first, second),
-    "and": lambda first,second: builder.and_(first, second),
-    "or": lambda first,second: builder.or_(first, second),
-    "!=": lambda first,second: builder.icmp_signed("!=",first,second),
-    "=": lambda first,second: builder.icmp_signed("==",first,second),
-    "<": lambda first,second: builder.icmp_signed("<",first,second),
-    ">": lambda first,second: builder.icmp_signed(">",first,second),
-    "<=": lambda first,second: builder.icmp_signed("<=",first,second),
-    ">=": lambda first,second: builder.icmp_signed(">=",first,second)
-
-    }
-
-    operations = {
-
-    "+": lambda first,second: first+second,
-    "-": lambda first,second: first-second,
-    "not": lambda first,second: not first,
-    "*": lambda first,second: first*second,
-    "/": lambda first,second: int(first/second),
-    "%": lambda first,second: first%second,
-    "**": lambda first,second: first**second,
-    "and": lambda first,second: first and second,
-    "or": lambda first,second: first or second,
-    "!=": lambda first,second: first != second,
-    "=": lambda first,second: first == second,
-    "<": lambda first,second: first<second,
-    ">": lambda first,second: first>second,
-    "<=": lambda first,second: first<=second,
-    ">=": lambda first,second: first >= second,
-    }
-    
-
-    #print (scope)
-    #print ("node = ",node,node.first,node.second)
-
-    if node.id == "Name":
-        try:
-            if type (scope.names[node.value]) == list:
-                return scope.names[node.value]
-            else:
-                if builder == None:
-                    try:
-                        return int(scope.names[node.value])
-                    except:
-                        return scope.names[node.value]
+    return Evaluator(scope, builder, module, printf).eval(node)
+
+
+# (node class, id, name, arity, mode) -> (shape, Evaluator method)
+handlers = {}
+
+# shape of the nodes, the operands are evaluated first (explicit stack)
+LEAF, FIRST, SECOND, BOTH = range(4)
+
+
+class Evaluator:
+
+    """Evaluation (builder == None) or code generation (builder != None)
+    of AST nodes, see Eval.
+    The method for a node is chosen once for each kind of node, key
+    (node class, id, name, arity), and kept in <handlers>.
+    The number (int or float) of the Const nodes is kept in the node (node.number).
+    Operators and assignments are evaluated with an explicit stack, not
+    recursion, so very long expressions are fine.
+    strings -- {text: pointer} global constants of the module, see string().
+        The CodeGen of the module keeps it, one for every Evaluator.
+    export -- the functions defined are called from other modules or ctypes:
+        external, C calling convention. Else internal and fastcc.
+    Code generation numbers the values of the operators (local value numbering):
+    an operator with the same operands as one already generated in the current
+    basic block reuses its LLVM value, print(b+c, b+c) has one add.
+    The names assigned by the generated code are SSA values (<variables>): if
+    and while get their own basic blocks and phi nodes where the paths join.
+    The names that functions read from the top level are module globals
+    (<globals>), stored by the top level and loaded where they are used.
+    The values of the scope of the parser are only for the interpreter.
+    types -- inference.Types of the program: the names, arguments and results
+        are i1 (bool), i64 (int) or double (float). int if unknown (None).
+    context -- function of the generated code, None for the top level
+    arrays -- {(type, values): pointer} global constants of the module for the
+        list literals, see list_ir. Kept like <strings>.
+    errors -- (jmp_buf, message) globals of the REPL: a runtime error stores its
+        message and longjmps to the input being run instead of exiting, and the
+        int divisions are checked (sdiv by 0 kills the process). See check.
+    The list literals of numbers are arrays (see array_ty): read-only globals if
+    the elements are constants. l.i is the element i (from the end if negative,
+    error if out of range) and the operators + - * / of arrays (or an array and
+    a number) are a loop over the elements, vectorized by LLVM (-O2).
+    """
+
+    def __init__ (self, scope, builder=None, module=None, printf=None, strings=None,
+                  export=False, types=None, context=None, arrays=None):
+
+        self.scope = scope
+        self.builder = builder
+        self.module = module
+        self.printf = printf
+        self.strings = {} if strings is None else strings
+        self.arrays = {} if arrays is None else arrays
+        self.errors = None
+        self.export = export
+        self.types = types
+        self.context = context
+        self.variables = {} # name -> LLVM value now, assigned or argument of the function
+        self.globals = set() # names in module globals, see declare_globals
+        self.numbers = {} # (operator, operands) -> LLVM value in <block>
+        self.block = None
+
+
+    def eval (self, node):
+
+        """Value (or LLVM value) of <node>.
+        """
+
+        mode = self.builder is None
+        values = []
+        stack = [node] # nodes to evaluate and (method, node, operands) to apply
+
+        while stack:
+            node = stack.pop()
+
+            if type(node) is tuple:
+                method, node, n = node
+                if n == 1:
+                    values[-1] = method(self, node, values[-1])
                 else:
-                    try:
-                        return i32_ty(int(scope.names[node.value]))
-                    except:
-                        return scope.names[node.value]
-        except:
-            raise NotDefined('Name "%s" is not defined' % node.value)
-
-
-    if node.id == "Const":
-        if builder == None:
-            try: 
-                return int(node.value)
-            except:
-                return node.value
-        else:
+                    second = values.pop()
+                    values[-1] = method(self, node, values[-1], second)
+                continue
+
+            key = (node.__class__, node.id, node.name, node.arity, mode)
             try:
-                return i32_ty(int(node.value))
-            except:
-                return node.value.strip('"')
+                shape, method = handlers[key]
+            except KeyError:
+                shape, method = handlers[key] = self.dispatch(node)
+
+            if shape == LEAF:
+                values.append(method(self, node))
+            elif shape == BOTH:
+                stack.append((method, node, 2))
+                stack.append(node.second)
+                stack.append(node.first)
+            else:
+                stack.append((method, node, 1))
+                stack.append(node.first if shape == FIRST else node.second)
 
-    if node.name == "Assign":
+        return values[-1]
 
-        if builder == None:
-            return Eval(node.second,scope)
-        else:
-            val = Eval(node.second,scope,builder,module)
-            ptr = builder.alloca(val.type)
-            builder.store(val, ptr)
-            return val
 
-    if node.name == "List":
-        return str([x.value for x in node.first])
+    def dispatch (self, node):
+
+        """(shape, method) for <node>, same order as the old chain of if.
+        """
+
+        interpreter = self.builder is None
+
+        if node.id == "Name":
+            return LEAF, Evaluator.name
+        if node.id == "Const":
+            return LEAF, (Evaluator.const if interpreter else Evaluator.const_ir)
+        if node.name == "Assign":
+            return SECOND, (Evaluator.assign if interpreter else Evaluator.assign_ir)
+        if node.name == "List" or node.name == "Tuple":
+            return LEAF, (Evaluator.sequence if interpreter else Evaluator.list_ir)
+        if node.id == "." and not interpreter:
+            return BOTH, Evaluator.access_ir
+        # OPERATOR
+        if node.arity == 2:
+            if node.id not in (operations if interpreter else codegen):
+                raise KeyError(node.id)
+            return BOTH, (Evaluator.binary if interpreter else Evaluator.binary_ir)
+        if node.arity == 1:
+            if node.id not in unary_operations:
+                raise KeyError(node.id)
+            return FIRST, (Evaluator.unary if interpreter else Evaluator.unary_ir)
+        # is a statement
+        if interpreter:
+            return LEAF, Evaluator.procedure
+        if node.id == "Function":
+            return LEAF, Evaluator.function
+        if node.id == "CallFunc":
+            return LEAF, Evaluator.call
+        if node.id == "if":
+            return LEAF, Evaluator.if_ir
+        if node.id == "while":
+            return LEAF, Evaluator.while_ir
+        return LEAF, Evaluator.procedure_ir
+
+
+    # Values
+
+    @staticmethod
+    def number (node):
+
+        """int or float value of the Const <node>, None if it is not a number.
+        Computed once.
+        """
+
+        try:
+            return node.number
+        except AttributeError:
+            node.number = literal(node.value)
+            return node.number
+
+
+    def type_of (self, name):
+
+        # LLVM type of the variable <name> in the generated code
+        if self.types is None:
+            return i64_ty
+        return llvm_types[self.types.of(self.context, name)]
+
+
+    def name (self, node):
+
+        if node.value in self.variables:
+            return self.variables[node.value]
+        if self.builder is None:
+            return self.name_value(node.value)
+        if node.value in self.globals:
+            return self.builder.load(self.global_variable(node.value), name=node.value)
+        raise NotDefined('Name "%s" is not defined' % node.value)
+
+
+    def name_value (self, name):
+
+        # value of <name> in the scope of the parser
+        try:
+            value = self.scope.names[name]
+        except (KeyError, AttributeError):
+            raise NotDefined('Name "%s" is not defined' % name)
+
+        if type(value) is list:
+            return value
+        number = literal(value)
+        return value if number is None else number
+
+
+    def const (self, node):
+
+        number = self.number(node)
+        return node.value if number is None else number
+
+
+    def const_ir (self, node):
+
+        number = self.number(node)
+        if number is None:
+            return node.value.strip('"')
+        return (double_ty if type(number) is float else i64_ty)(number)
+
+
+    def sequence (self, node):
 
-    if node.name == "Tuple":
         return str([x.value for x in node.first])
 
-    # OPERATOR
-    if node.arity == 2:
 
-        first= Eval(node.first,scope,builder,module)
-        second= Eval(node.second,scope,builder,module)
-        op = node.id
+    def list_ir (self, node):
 
-        if builder == None:
-            return operations[op](first,second)
-        else:
-            return codegen[op](first,second) 
+        """Array of the numbers of the list <node>, else its text (sequence).
+        Constant elements: a private constant global of the module, one for
+        each list of values. Else a new buffer.
+        """
+
+        values = [self.eval(x) for x in node.first]
+        if not all(isinstance(x, ir.Value) and isinstance(x.type, (ir.IntType, ir.DoubleType))
+                   for x in values):
+            return self.sequence(node)
+        ty = double_ty if any(x.type == double_ty for x in values) else i64_ty
+        n = i64_ty(len(values))
+
+        if all(isinstance(x, ir.Constant) for x in values):
+            convert = float if ty == double_ty else int
+            key = (str(ty), tuple(convert(x.constant) for x in values))
+            ptr = self.arrays.get(key)
+            if ptr is None:
+                data_ty = ir.ArrayType(ty, len(values))
+                var = ir.GlobalVariable(self.module, data_ty, name=self.module.get_unique_name(".array"))
+                var.linkage = "private"
+                var.unnamed_addr = True
+                var.global_constant = True
+                var.initializer = ir.Constant(data_ty, list(key[1]))
+                ptr = self.arrays[key] = var.gep([i32_ty(0), i32_ty(0)])
+            return ir.Constant(array_ty(ty), [n, ptr])
 
-    elif node.arity == 1:
+        data = self.allocate(ty, n)
+        for i, x in enumerate(values):
+            self.builder.store(self.cast(x, ty), self.builder.gep(data, [i64_ty(i)]))
+        return self.array_value(n, data)
 
-        second= Eval(node.first,scope,builder,module)
-        first = i32_ty(int(0))
-        op = node.id
 
-        if builder == None:
-            return operations[op](first,second)
+    def assign (self, node, val):
+
+        return val
+
+
+    def assign_ir (self, node, val):
+
+        if node.first.id != "Name":
+            return val
+        name = node.first.value
+        if not isinstance(val, ir.Value):
+            self.variables[name] = val # a text (print)
+            return val
+        val = self.cast(val, self.type_of(name))
+        if name in self.globals:
+            self.builder.store(val, self.global_variable(name))
+            self.variables.pop(name, None)
         else:
-            return codegen[op](first,second) 
-    
-    else:
-        # is a statement
-        # only print call considered.
+            self.variables[name] = val # SSA
+        return val
+
+
+    # Globals
+
+    def global_variable (self, name):
+
+        """Global <name> of the module (type of the top level name), declared
+        (external, defined by other module) if it is not there.
+        """
+
+        var = self.module.globals.get(name)
+        if not isinstance(var, ir.GlobalVariable):
+            ty = llvm_types[self.types.of(None, name)] if self.types is not None else i64_ty
+            var = ir.GlobalVariable(self.module, ty, name=name)
+        return var
+
+
+    def define_global (self, name):
+
+        # global <name> defined in this module, 0 until assigned
+        var = self.global_variable(name)
+        var.initializer = ir.Constant(var.value_type, None)
+        if not self.export:
+            var.linkage = "internal"
+        self.globals.add(name)
+        return var
+
 
-        if builder !=None:
+    def declare_globals (self, nodes):
 
-            func_name = node.first.value
-            args = [x.value for x in node.second[0]]
+        """Defines the globals of the names that the functions of <nodes> (top
+        level statements) read and do not assign, and that the top level
+        assigns. The other names they read are not defined (NotDefined).
+        """
 
+        from optimizer import assigned
 
-            if func_name == "print":
-                eval_print(node,scope,builder,module,printf)
+        nodes = nodes or []
+        top = assigned([node for node in nodes if node.id != "Function"])
+        names = set()
+        for node in nodes:
+            if node.id == "Function":
+                names |= free_names(node) & top
+        for name in sorted(names):
+            self.define_global(name)
 
-            # basic functions
-            elif node.id== "Function":
-                #print (node)
-                #print (func_name)
-                #print (args)
 
-                # de momento solo tipo int
-                type_arg = [i32_ty for i in args]
+    # Operators, the operands are evaluated by eval
 
-                func_ty = ir.FunctionType(ir.IntType(32), type_arg)
-                func = ir.Function(module, func_ty, name=func_name)
+    def binary (self, node, first, second):
 
-                for i in range(len(args)):
-                    func.args[i].name = args[i]
+        return operations[node.id](first, second)
 
-                name_block = func_name+"_entry"
-                fn_block = func.append_basic_block(name_block)
-                func_builder = ir.IRBuilder(fn_block)
 
-                tmp = Eval(node.second[1][0],scope,func_builder,module)
-                ret = func_builder.ret(tmp)
+    def binary_ir (self, node, first, second):
 
-                #print(module)
-            elif node.id == "CallFunc":
-                return "CALL"
+        numbers = self.block_numbers()
+        key = (node.id, first, second)
+        value = numbers.get(key)
+        if value is None and node.id in commutative:
+            value = numbers.get((node.id, second, first))
+        if value is None:
+            value = self.operation(node.id, first, second)
+            self.block_numbers()[key] = value # a loop of arrays ends in other block
+        return value
+
+
+    def operation (self, id, first, second):
+
+        """<first> <id> <second>: double if an operand is double (fadd, fcmp...),
+        else i64. "and" and "or" of two i1 are i1, else i64 (bitwise).
+        Arrays element by element, see elementwise.
+        """
+
+        if is_array(getattr(first, "type", None)) or is_array(getattr(second, "type", None)):
+            return self.elementwise(id, first, second)
+        types = (numeric(first), numeric(second))
+        if id in ("and", "or"):
+            ty = i1_ty if types == (i1_ty, i1_ty) else i64_ty
+        else:
+            ty = double_ty if double_ty in types else i64_ty
+        table = float_codegen if ty == double_ty else codegen
+        first, second = self.cast(first, ty), self.cast(second, ty)
+        if id == "/" and ty == i64_ty:
+            self.check_division(first, second)
+        return table[id](self.builder, first, second)
+
+
+    def unary (self, node, second):
+
+        return unary_operations[node.id](second)
+
+
+    def unary_ir (self, node, second):
+
+        numbers = self.block_numbers()
+        key = (node.name, second)
+        value = numbers.get(key)
+        if value is None:
+            if node.id == "-" and is_array(getattr(second, "type", None)):
+                value = self.elementwise("-", i64_ty(0), second)
             else:
-                pass
+                if node.id != "not":
+                    second = self.cast(second, double_ty if numeric(second) == double_ty else i64_ty)
+                value = unary_codegen[node.id](self.builder, second)
+            self.block_numbers()[key] = value
+        return value
+
+
+    def block_numbers (self):
+
+        """Value numbers of the current basic block of the builder, see binary_ir.
+        The operators are pure: a value of the block can be used later in it.
+        """
+
+        if self.builder.block is not self.block:
+            self.block = self.builder.block
+            self.numbers = {}
+        return self.numbers
+
+
+    # Arrays
+
+    def allocate (self, ty, n):
+
+        # new buffer of <n> (i64) elements of type <ty>, malloc (never freed)
+        malloc = self.module.globals.get("malloc")
+        if not isinstance(malloc, ir.Function):
+            malloc = ir.Function(self.module, ir.FunctionType(ir.IntType(8).as_pointer(), [i64_ty]),
+                                 name="malloc")
+            malloc.return_value.add_attribute("noalias")
+        size = self.builder.mul(n, i64_ty(element_size))
+        return self.builder.bitcast(self.builder.call(malloc, [size]), ty.as_pointer())
+
+
+    def array_value (self, n, data):
+
+        # array of length <n> and elements at <data>
+        value = ir.Constant(array_ty(data.type.pointee), ir.Undefined)
+        value = self.builder.insert_value(value, n, 0)
+        return self.builder.insert_value(value, data, 1)
+
+
+    def element (self, value, i):
+
+        # element <i> (i64) of the array <value>, not checked
+        data = self.builder.extract_value(value, 1)
+        return self.builder.load(self.builder.gep(data, [i]))
+
+
+    def access_ir (self, node, value, index):
+
+        """l.i: element of the array <value>, from the end if <index> is
+        negative (l.-1 is the last one). Error if it is out of range.
+        """
+
+        if not isinstance(value, ir.Value) or not is_array(value.type):
+            raise TypeError("%s is not an array" % getattr(node.first, "value", "value"))
+        builder = self.builder
+        n = builder.extract_value(value, 0)
+        i = self.cast(index, i64_ty)
+        i = builder.select(builder.icmp_signed("<", i, i64_ty(0)), builder.add(i, n), i)
+        self.check(builder.icmp_unsigned("<", i, n), "index out of range")
+        return self.element(value, i)
+
+
+    def elementwise (self, id, first, second):
+
+        """<first> <id> <second> element by element, arrays of the same length or
+        an array and a number. A new array, double if an operand is double.
+        """
+
+        if id not in ("+", "-", "*", "/"):
+            raise TypeError('"%s" of arrays is not supported' % id)
+        builder = self.builder
+        operands = (first, second)
+        types = [x.type.elements[1].pointee if is_array(x.type) else numeric(x) for x in operands]
+        ty = double_ty if double_ty in types else i64_ty
+        arrays = [x for x in operands if is_array(x.type)]
+        n = builder.extract_value(arrays[0], 0)
+        if len(arrays) == 2:
+            other = builder.extract_value(arrays[1], 0)
+            self.check(builder.icmp_signed("==", n, other), "arrays of different length")
+        # the numbers are converted once, out of the loop
+        operands = [x if is_array(x.type) else self.cast(x, ty) for x in operands]
+        table = float_codegen if ty == double_ty else codegen
+        data = self.allocate(ty, n)
+
+        def body (i):
+            a, b = [self.cast(self.element(x, i), ty) if is_array(x.type) else x for x in operands]
+            if id == "/" and ty == i64_ty:
+                self.check_division(a, b)
+            builder.store(table[id](builder, a, b), builder.gep(data, [i]))
+
+        self.loop(n, body)
+        return self.array_value(n, data)
+
+
+    def convert (self, value, ty):
+
+        # the array <value> as a new array of type <ty>, int[] -> float[]
+        builder = self.builder
+        n = builder.extract_value(value, 0)
+        element_ty = ty.elements[1].pointee
+        data = self.allocate(element_ty, n)
+        self.loop(n, lambda i: builder.store(self.cast(self.element(value, i), element_ty),
+                                             builder.gep(data, [i])))
+        return self.array_value(n, data)
+
+
+    def loop (self, n, body):
+
+        """for i in 0..<n>-1: body(i), blocks "loop" (i phi and condition),
+        "loop.body" and "endloop". The builder ends in "endloop".
+        """
+
+        builder = self.builder
+        before = builder.block
+        header = builder.append_basic_block("loop")
+        block = builder.append_basic_block("loop.body")
+        end = builder.append_basic_block("endloop")
+        builder.branch(header)
+
+        builder.position_at_end(header)
+        i = builder.phi(i64_ty, name="i")
+        i.add_incoming(i64_ty(0), before)
+        builder.cbranch(builder.icmp_signed("<", i, n), block, end)
+
+        builder.position_at_end(block)
+        body(i)
+        i.add_incoming(builder.add(i, i64_ty(1)), builder.block)
+        builder.branch(header)
+        builder.position_at_end(end)
+
+
+    def check (self, cond, message):
+
+        """Runtime error: prints <message> and exits with status 1 unless the
+        i1 <cond>. In the REPL (<errors>) the message is stored and the input
+        ends (longjmp), the process goes on. The builder goes on in the block
+        where it holds.
+        """
+
+        builder = self.builder
+        ok = builder.append_basic_block("ok")
+        error = builder.append_basic_block("error")
+        builder.cbranch(cond, ok, error)
+        builder.position_at_end(error)
+        if self.errors is not None:
+            jmp_buf, text = self.errors
+            builder.store(self.string("error: %s\0" % message), text)
+            longjmp = self.libc_function("longjmp", ir.VoidType(), [i8_ptr_ty, i32_ty])
+            longjmp.attributes.add("noreturn")
+            builder.call(longjmp, [jmp_buf.bitcast(i8_ptr_ty), i32_ty(1)])
         else:
-            return "PROC"
+            builder.call(self.printf, [self.string("error: %s\n\0" % message)])
+            exit = self.libc_function("exit", ir.VoidType(), [i32_ty])
+            builder.call(exit, [i32_ty(1)])
+        builder.unreachable()
+        builder.position_at_end(ok)
+
+
+    def check_division (self, first, second):
+
+        # REPL: the i64 <first> / <second> that trap (SIGFPE) are runtime errors
+        if self.errors is None:
+            return
+        builder = self.builder
+        self.check(builder.icmp_signed("!=", second, i64_ty(0)), "division by zero")
+        overflow = builder.and_(builder.icmp_signed("==", first, i64_ty(-2**63)),
+                                builder.icmp_signed("==", second, i64_ty(-1)))
+        self.check(builder.not_(overflow), "division overflow")
+
+
+    def libc_function (self, name, ret, args):
+
+        # ir.Function of the C library function <name>, declared once in the module
+        func = self.module.globals.get(name)
+        if not isinstance(func, ir.Function):
+            func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+        return func
+
+
+    # Statements
+
+    def procedure (self, node):
+
+        return "PROC"
+
+
+    def procedure_ir (self, node):
+
+        # only print call and functions considered.
+        if getattr(node.first, "value", None) == "print":
+            self.print_call(node)
+
+
+    def statements (self, nodes):
+
+        # block of statements: list, None if empty
+        for node in nodes or ():
+            self.eval(node)
+
+
+    def truth (self, value):
+
+        # i1 of the condition <value>
+        if numeric(value) == i1_ty:
+            return value
+        if value.type == double_ty:
+            return self.builder.fcmp_unordered("!=", value, value.type(0))
+        return self.builder.icmp_signed("!=", value, value.type(0))
+
+
+    def cast (self, value, ty):
+
+        """<value> as a value of type <ty> (i1, i32, i64 or double): i1 is 0 or 1,
+        the ints are signed and the doubles are truncated to int. Arrays only
+        as arrays.
+        """
+
+        builder = self.builder
+        if isinstance(value, ir.Value) and is_array(value.type) and is_array(ty):
+            return value if value.type == ty else self.convert(value, ty)
+        if numeric(value) == ty:
+            return value
+        if is_array(ty):
+            raise TypeError("a number is not an array")
+        if ty == i1_ty:
+            return self.truth(value)
+        if value.type == i1_ty:
+            return builder.uitofp(value, ty) if ty == double_ty else builder.zext(value, ty)
+        if ty == double_ty:
+            return builder.sitofp(value, ty)
+        if value.type == double_ty:
+            return builder.fptosi(value, ty)
+        if value.type.width < ty.width:
+            return builder.sext(value, ty)
+        return builder.trunc(value, ty)
+
+
+    def if_ir (self, node):
+
+        """if <first> then <second> else <third>: a block for each branch and
+        the merge block "endif", with a phi for the names the branches change.
+        """
+
+        builder = self.builder
+        cond = self.truth(self.eval(node.first))
+        then_block = builder.append_basic_block("then")
+        else_block = builder.append_basic_block("else") if node.third else None
+        merge = builder.append_basic_block("endif")
+        builder.cbranch(cond, then_block, else_block or merge)
+
+        before = self.variables
+        paths = [] # (variables, last block) that reach the merge
+        if else_block is None:
+            paths.append((before, builder.block))
+        for block, nodes in ((then_block, node.second), (else_block, node.third)):
+            if block is None:
+                continue
+            self.variables = dict(before)
+            builder.position_at_end(block)
+            self.statements(nodes)
+            if not builder.block.is_terminated:
+                builder.branch(merge)
+                paths.append((self.variables, builder.block))
+
+        builder.position_at_end(merge)
+        self.variables = self.join(paths)
+
+
+    def join (self, paths):
+
+        """Variables after the merge of <paths>, (variables, block) that branch
+        to the current block, a phi for the names whose values differ. A name
+        not assigned in a path is 0 there. The values join as the widest type
+        (i1 < i64 < double).
+        """
+
+        builder = self.builder
+        variables = {}
+        names = []
+        for path, block in paths:
+            names.extend(name for name in path if name not in names)
+        for name in names:
+            values = [path.get(name) for path, block in paths]
+            value = values[0]
+            if all(x is value for x in values):
+                variables[name] = value
+                continue
+            numbers = [x for x in values if x is not None]
+            if not all(isinstance(x, ir.Value) for x in numbers):
+                continue # texts
+            ty = max((x.type for x in numbers), key=rank)
+            values = [ir.Constant(ty, None) if x is None else x for x in values]
+            phi = builder.phi(ty, name=name)
+            for x, (path, block) in zip(values, paths):
+                with builder.goto_block(block): # before its branch
+                    phi.add_incoming(self.cast(x, ty), block)
+            variables[name] = phi
+        return variables
+
+
+    def while_ir (self, node):
+
+        """while <first> :: <second>: blocks "while" (condition), "do" (body,
+        back edge to the condition) and "endwhile". The names assigned in the
+        loop are phi nodes in the condition block (0 before the loop if they are
+        not assigned yet), except the globals.
+        """
+
+        from optimizer import assigned
+
+        builder = self.builder
+        before = builder.block
+        header = builder.append_basic_block("while")
+        body = builder.append_basic_block("do")
+        end = builder.append_basic_block("endwhile")
+        builder.branch(header)
+
+        builder.position_at_end(header)
+        phis = {}
+        for name in sorted(assigned([node.first, node.second])):
+            value = self.variables.get(name)
+            if value is None:
+                if name in self.globals:
+                    continue
+                value = ir.Constant(self.type_of(name), None)
+            if isinstance(value, ir.Value):
+                phi = phis[name] = builder.phi(value.type, name=name)
+                phi.add_incoming(value, before)
+                self.variables[name] = phi
+        cond = self.truth(self.eval(node.first))
+        builder.cbranch(cond, body, end)
+        after = dict(self.variables)
+
+        builder.position_at_end(body)
+        self.statements(node.second)
+        if not builder.block.is_terminated:
+            for name, phi in phis.items():
+                phi.add_incoming(self.cast(self.variables.get(name, phi), phi.type), builder.block)
+            builder.branch(header)
+
+        builder.position_at_end(end)
+        self.variables = after
+
+
+    def call (self, node):
+
+        if node.first.value == "print":
+            self.print_call(node)
+            return
+        # function of the module, declared before the code (see declare_functions)
+        # or defined by other module (repl.py, session.py)
+        func = self.module.globals.get(node.first.value)
+        if not isinstance(func, ir.Function):
+            if node.first.value == "len" and len(node.second[0]) == 1:
+                return self.length(self.eval(node.second[0][0]))
+            raise NotDefined('Function "%s" is not defined' % node.first.value, node.first.value)
+        if len(node.second[0]) != len(func.args):
+            raise TypeError("%s takes %d arguments" % (func.name, len(func.args)))
+        args = [self.cast(self.eval(arg), param.type)
+                for arg, param in zip(node.second[0], func.args)]
+        return self.builder.call(func, args) # calling convention of func
+
+
+    def function (self, node):
+
+        # basic functions
+        func_name = node.first.value
+        args = [x.value for x in node.second[0]]
+
+        if func_name == "print":
+            self.print_call(node)
+            return
+
+        func = self.declare_function(func_name, len(args))
+        func_ty = func.ftype
+        if not func.is_declaration:
+            raise NameError("Function %r already defined" % func_name)
+        if not self.export:
+            func.linkage = "internal"
+
+        for i in range(len(args)):
+            func.args[i].name = args[i]
+
+        name_block = func_name+"_entry"
+        fn_block = func.append_basic_block(name_block)
+        func_builder = ir.IRBuilder(fn_block)
+
+        body = Evaluator(self.scope, func_builder, self.module, self.printf, self.strings,
+                         self.export, self.types, func_name, self.arrays)
+        body.variables = dict(zip(args, func.args))
+        body.globals = free_names(node) & self.globals
+        body.errors = self.errors
+        body.statements(node.third) # fib (x) -> y :: if ... then y:1 else y:...
+        tmp = body.eval(node.second[1][0])
+        func_builder.ret(body.cast(tmp, func_ty.return_type))
+        body.tail_calls(func)
+
+
+    def declare_function (self, name, arity):
+
+        """Function <name> of the module, declared if it is not there: the types
+        of its arguments and result (inference.Types, int if unknown), fastcc
+        unless export.
+        """
+
+        func = self.module.globals.get(name)
+        if isinstance(func, ir.Function):
+            return func
+        params, ret = ([INT] * arity, INT) if self.types is None else \
+            self.types.signature(name, arity)
+        func_ty = ir.FunctionType(llvm_types[ret], [llvm_types[t] for t in params])
+        func = ir.Function(self.module, func_ty, name=name)
+        if not self.export:
+            func.calling_convention = "fastcc"
+        return func
+
+
+    def declare_functions (self, nodes):
+
+        """Declares the functions defined by the Function <nodes> (top level
+        statements): they can be called before their definition, or from
+        other modules (linked, see session.py).
+        """
+
+        for node in nodes or ():
+            if node.id == "Function" and node.first.value != "print":
+                self.declare_function(node.first.value, len(node.second[0]))
+
+
+    def tail_calls (self, func):
+
+        """Marks musttail the calls of <func> to itself that are returned, after
+        its ret: the recursion runs in constant stack, even at -O0.
+            f (x) -> f(x-1)
+            f (x) -> y :: if ... then y: 1 else y: f(x-1)
+        In the second case the branch of the call returns it, without going
+        through the phi of the merge block.
+        """
+
+        builder = self.builder
+        block = builder.block
+        value = block.terminator.operands[0]
+        if self.returns_call(value, func, block):
+            value.tail = "musttail"
+            return
+
+        phis = block.instructions[:-1]
+        if not isinstance(value, ir.PhiInstr) or not all(isinstance(x, ir.PhiInstr) for x in phis):
+            return
+        for incoming, pred in list(value.incomings):
+            if len(value.incomings) == 1:
+                break # the phi needs an entry
+            if type(pred.terminator) is ir.Branch and self.returns_call(incoming, func, pred):
+                pred.instructions.pop() # br to the merge block
+                pred.terminator = None
+                for phi in phis:
+                    phi.incomings = [(x, b) for x, b in phi.incomings if b is not pred]
+                with builder.goto_block(pred):
+                    builder.ret(incoming)
+                incoming.tail = "musttail"
+
+
+    def length (self, value):
+
+        # len(l), i64 length of the array <value>
+        if not isinstance(value, ir.Value) or not is_array(value.type):
+            raise TypeError("len of a value that is not an array")
+        return self.builder.extract_value(value, 0)
+
+
+    @staticmethod
+    def returns_call (value, func, block):
+
+        # <value> is a call to <func> just before the terminator of <block>
+        return (isinstance(value, ir.CallInstr) and value.callee is func and
+                len(block.instructions) > 1 and block.instructions[-2] is value)
+
+
+    def print_call (self, node):
+
+        # print ("hola mundo",5) -> CallFunc(Name (print),[[Const ("hola mundo"), Const (5)]])
+
+        end = "\n\0"
+        arg = ""
+        values = []
+
+        args = node.second[0] # list of arguments to print
+        for a in args:
+
+            arg_value = self.eval(a)
+            if type(arg_value) == str:
+                arg += arg_value.replace("%", "%%")
+            elif is_array(arg_value.type):
+                self.builder.call(self.printf, [self.string(arg + "[\0")] + values)
+                self.print_array(arg_value)
+                arg, values = "]", []
+            elif arg_value.type == double_ty:
+                arg += "%.16g"
+                values.append (arg_value)
+            else:
+                arg += "%lld"
+                values.append (self.cast(arg_value, i64_ty))
+
+        arg+=end
+
+        # Call Print Function
+        in_ = [self.string(arg)]
+        in_ += values
+        self.builder.call(self.printf, in_)
+
+
+    def print_array (self, value):
+
+        # elements of the array <value>, "1, 2, 3"
+        builder = self.builder
+        ty = value.type.elements[1].pointee
+        first, other = ("%.16g\0", ", %.16g\0") if ty == double_ty else ("%lld\0", ", %lld\0")
+        first, other = self.string(first), self.string(other)
+        self.loop(builder.extract_value(value, 0), lambda i: builder.call(self.printf, [
+            builder.select(builder.icmp_signed("==", i, i64_ty(0)), first, other),
+            self.element(value, i)]))
+
+
+    def string (self, text):
+
+        """i8* to the bytes of <text> (utf8, with its "\\0"): a private constant
+        of the module, one for each text (not copied to the stack on each call).
+        """
+
+        try:
+            return self.strings[text]
+        except KeyError:
+            pass
+        data = bytearray(text.encode("utf8"))
+        array_ty = ir.ArrayType(ir.IntType(8), len(data))
+        var = ir.GlobalVariable(self.module, array_ty, name=self.module.get_unique_name(".str"))
+        var.linkage = "private"
+        var.unnamed_addr = True
+        var.global_constant = True
+        var.initializer = ir.Constant(array_ty, data)
+        ptr = self.strings[text] = var.gep([i32_ty(0), i32_ty(0)])
+        return ptr
 
 
 class NotDefined(Exception):
-    pass
 
+    """Name or function not defined. function -- the function called, None for a name.
+    """
 
+    def __init__ (self, message, function=None):
 
-def eval_print(node,scope,builder,module,printf):
+        Exception.__init__(self, message)
+        self.function = function
 
-    # print ("hola mundo",5) -> CallFunc(Name (print),[[Const ("hola mundo"), Const (5)]])
 
-    end = "\n\0"
-    arg = ""
-    values = []
+def numeric (value):
+
+    """LLVM type of the number <value>, TypeError if it is not a number
+    (texts, statements).
+    """
 
-    args = node.second[0] # list of arguments to print
-    for a in args:
+    if isinstance(value, ir.Value) and isinstance(value.type, (ir.IntType, ir.DoubleType)):
+        return value.type
+    if isinstance(value, ir.Value) and is_array(value.type):
+        raise TypeError("an array is not a number")
+    raise TypeError("%r is not a number" % (value,))
 
-        arg_value = Eval(a,scope,builder,module)
-        if type(arg_value) == str:
-            arg += arg_value
-        else:
-            arg += "%i"
-            values.append (arg_value)
-            
-    arg+=end
-
-    voidptr_ty = ir.IntType(8).as_pointer()    
-    c_str_val = ir.Constant(ir.ArrayType(ir.IntType(8), len(arg)),
-                            bytearray(arg.encode("utf8")))
-
-    c_str = builder.alloca(c_str_val.type)
-    builder.store(c_str_val, c_str)
-    fmt_arg = builder.bitcast(c_str, voidptr_ty)
-
-    # Call Print Function
-    in_ = [fmt_arg]
-    in_ += values
-    builder.call(printf, in_)
+
+def is_array (ty):
+
+    # <ty> is an LLVM array type, see array_ty
+    return isinstance(ty, ir.LiteralStructType)
+
+
+def rank (ty):
+
+    # order of the LLVM types of the values, see Evaluator.join
+    if is_array(ty):
+        return 256 + rank(ty.elements[1].pointee)
+    return ty.width if isinstance(ty, ir.IntType) else 128
+
+
+def free_names (node):
+
+    """Names read by the Function <node> that are not its arguments nor
+    assigned in it: globals if the top level assigns them, see declare_globals.
+    The called functions are not names.
+    """
+
+    from optimizer import assigned
+
+    local = assigned(node.third, {x.value for x in node.second[0]})
+    names = set()
+    stack = [node.second[1], node.third]
+    while stack:
+        x = stack.pop()
+        if x is None or isinstance(x, str):
+            continue
+        if isinstance(x, list):
+            stack.extend(x)
+        elif x.id == "Name":
+            if x.value not in local:
+                names.add(x.value)
+        elif x.id == "CallFunc":
+            stack.append(x.second)
+        elif x.id not in ("Function", "lambda"):
+            stack.extend((x.first, x.second, x.third))
+    return names
+
+
+
+def eval_print(node,scope,builder,module,printf):
+
+    # print ("hola mundo",5) -> CallFunc(Name (print),[[Const ("hola mundo"), Const (5)]])
+    Evaluator(scope, builder, module, printf).print_call(node)
@@ -0,0 +1,460 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 2018 Marcos V. Conde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+
+from myeval import operations, unary_operations
+from inference import literal, infer, Inference, BOOL, INT
+from sqyparser import symbol_table, copy_node
+
+
+#--------------------------------------------------------------------------------------------
+# AST OPTIMIZER
+#
+# tree,scope = ast(program)
+# tree = fold(tree)
+# codegen.generate(tree, scope)
+#
+# - Constant folding: Add (Const 4, Const 5) -> Const 9, with the operations tables of
+#   myeval and the i64 arithmetic of the generated code. Only ints are folded, the
+#   floats (1.56, pi) are left to LLVM.
+# - Constant propagation: after a:5 the Name a is Const 5 until a is assigned again,
+#   only if a is an int (inference): a name assigned a float anywhere is a float.
+#   Names assigned inside a while are unknown in the loop and after it,
+#   and after an if only the values of both branches agree on are kept.
+#   Function and lambda bodies are folded without the outer constants
+#   (they run when called), and the names they assign are never propagated.
+# - Algebraic identities: x*1, 1*x, x/1, x+0, 0+x, x-0 -> x ; x*0, 0*x -> 0 only if
+#   x is an int (inference, the program is inferred when one is found): a float x*0
+#   is 0.0 or nan (inf*0), an array x*0 is an array.
+#
+# "and", "or", "not", "%" and "**" are not folded: the generated code does not
+# give them the meaning of the interpreter (bitwise and/or) or does not support them.
+#
+# The nodes of the tree are never changed, a node with folded children is a copy
+# (copy-on-write): nodes may be shared (Parser(intern=...), session.Session).
+
+
+folding = ("+", "-", "*", "/", "!=", "=", "<", ">", "<=", ">=")
+assignments = (":", ":=")
+
+# Folder.expr stack, operands to complete
+FIRST, SECOND, BOTH = range(3)
+
+LAMBDA = object() # Folder.scope in a lambda
+
+I64_MIN = -2**63
+
+
+def i64 (value):
+
+    """Python int -> value of a i64 (two's complement).
+    """
+
+    return (value - I64_MIN) % 2**64 + I64_MIN
+
+
+def number (node):
+
+    """Value of the int Const <node> as the code generator sees it, else None.
+    """
+
+    if node is None or isinstance(node, list) or node.id != "Const":
+        return None
+    value = literal(node.value)
+    return value if type(value) is int else None
+
+
+def const (value):
+
+    """New Const node of the int <value>.
+    """
+
+    node = symbol_table["Const"]()
+    node.value = str(value)
+    return node
+
+
+def value_of (node):
+
+    """Value of the expression <node> if known: Const or assignment chain a:b:5.
+    """
+
+    while node is not None and not isinstance(node, list) and node.id in assignments:
+        node = node.second
+    return number(node)
+
+
+def rebuild (node, first, second, third):
+
+    """<node> with the children <first>, <second> and <third>: itself if they
+    are the same objects, else a copy.
+    """
+
+    if first is node.first and second is node.second and third is node.third:
+        return node
+    node = copy_node(node)
+    node.first, node.second, node.third = first, second, third
+    return node
+
+
+def same (items, other):
+
+    # the lists have the same objects
+    return len(items) == len(other) and all(a is b for a, b in zip(items, other))
+
+
+def walk (node):
+
+    """Every node of <node> (node or list of nodes), without recursion.
+    """
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is None or isinstance(node, str):
+            continue
+        if isinstance(node, list):
+            stack.extend(node)
+            continue
+        yield node
+        stack.append(node.third)
+        stack.append(node.second)
+        stack.append(node.first)
+
+
+def pure (node):
+
+    """True if <node> has no calls nor assignments, then it can be removed.
+    """
+
+    for x in walk(node):
+        if x.id in assignments or x.id in ("CallFunc", "Function"):
+            return False
+    return True
+
+
+def assigned (node, names=None):
+
+    """Names assigned anywhere in <node> (node or list of nodes).
+    """
+
+    if names is None:
+        names = set()
+    for x in walk(node):
+        if x.id in assignments and x.first is not None and x.first.id == "Name":
+            names.add(x.first.value)
+    return names
+
+
+def function_names (node, names=None):
+
+    """Names assigned inside the functions and lambdas of <node>.
+    """
+
+    if names is None:
+        names = set()
+    for x in walk(node):
+        if x.id in ("Function", "lambda"):
+            assigned([x.second, x.third], names)
+    return names
+
+
+#--------------------------------------------------------------------------------------------
+
+
+def fold (tree):
+
+    """Folds the constants of the AST <tree> (Module node). Return the folded
+    tree, <tree> is not changed (shares the nodes not folded).
+    """
+
+    folder = Folder(function_names(tree.first), tree.first)
+    return rebuild(tree, folder.statements(tree.first, {}), tree.second, tree.third)
+
+
+class Folder:
+
+    """Constant folding with an environment {name: int} of the known names.
+    unsafe -- names never propagated (assigned by functions)
+    nodes -- top level statements of the program, for the types (integral)
+    """
+
+    def __init__ (self, unsafe, nodes):
+
+        self.unsafe = unsafe
+        self.assigned = (None, None) # last assignment and its value (a:b:c:...)
+        self.nodes = nodes
+        self.types = None # inference.Types of <nodes>, inferred when needed
+        self.scope = None # function folded (None: top level, LAMBDA)
+
+
+    def statements (self, nodes, env):
+
+        """Folds the statement list <nodes> in order, updates <env>.
+        """
+
+        if nodes is None:
+            return None
+        folded = [self.expr(node, env) for node in nodes]
+        return nodes if same(folded, nodes) else folded
+
+
+    def child (self, node, env):
+
+        # node, list of nodes (args, blocks...) or None
+        if node is None or isinstance(node, str):
+            return node
+        if isinstance(node, list):
+            folded = [self.child(x, env) for x in node]
+            return node if same(folded, node) else folded
+        return self.expr(node, env)
+
+
+    def expr (self, node, env):
+
+        """Folds <node>, return the new node.
+        Operators and assignments with an explicit stack (long expressions),
+        statements with a call for each block.
+        """
+
+        results = []
+        stack = [node] # nodes to fold and (kind, node) to complete
+
+        while stack:
+            node = stack.pop()
+
+            if type(node) is tuple:
+                kind, node = node
+                if kind == FIRST:
+                    node = rebuild(node, results.pop(), node.second, node.third)
+                    if node.id in ("+", "-"):
+                        value = number(node.first)
+                        if value is not None:
+                            node = const(i64(unary_operations[node.id](value)))
+                elif kind == SECOND:
+                    node = rebuild(node, node.first, results.pop(), node.third)
+                    self.assign(node, env)
+                else:
+                    second = results.pop()
+                    node = rebuild(node, results.pop(), second, node.third)
+                    if node.id in folding:
+                        node = self.binary(node)
+                results.append(node)
+                continue
+
+            id = node.id
+
+            if id == "Name":
+                results.append(const(env[node.value]) if node.value in env else node)
+
+            elif id == "Const":
+                results.append(node)
+
+            elif id in assignments and self.operand(node.second):
+                stack.append((SECOND, node))
+                stack.append(node.second)
+
+            elif node.arity == 2 and self.operand(node.first) and self.operand(node.second):
+                # infix operators
+                stack.append((BOTH, node))
+                stack.append(node.second)
+                stack.append(node.first)
+
+            elif node.arity == 1 and self.operand(node.first):
+                # prefix operators
+                stack.append((FIRST, node))
+                stack.append(node.first)
+
+            else:
+                results.append(self.statement(node, env))
+
+        return results[-1]
+
+
+    @staticmethod
+    def operand (node):
+
+        return node is not None and not isinstance(node, (list, str))
+
+
+    def assign (self, node, env):
+
+        # assignment done, update the known names
+        if self.assigned[0] is node.second and node.second is not None:
+            value = self.assigned[1]
+        else:
+            value = value_of(node.second)
+        self.assigned = (node, value)
+        if node.first is not None and node.first.id == "Name":
+            name = node.first.value
+            if value is None or name in self.unsafe or not self.integral_name(name):
+                env.pop(name, None)
+            else:
+                env[name] = value
+
+
+    def statement (self, node, env):
+
+        """Folds the other nodes: definitions, calls, while, if, lists...
+        """
+
+        id = node.id
+
+        if id in assignments:
+            node = rebuild(node, node.first, self.child(node.second, env), node.third)
+            self.assign(node, env)
+            return node
+
+        if id in ("Function", "lambda"):
+            # run when called, no outer constants
+            scope = self.scope
+            self.scope = node.first.value if id == "Function" else LAMBDA
+            try:
+                return rebuild(node, node.first, self.child(node.second, {}),
+                               self.child(node.third, {}))
+            finally:
+                self.scope = scope
+
+        if id == "global":
+            return node
+
+        if id == "CallFunc":
+            return rebuild(node, node.first, self.child(node.second, env), node.third)
+
+        if id == "while":
+            for name in assigned([node.first, node.second]):
+                env.pop(name, None)
+            first = self.expr(node.first, env)
+            return rebuild(node, first, self.statements(node.second, dict(env)), node.third)
+
+        if id == "if":
+            first = self.expr(node.first, env)
+            then_env, else_env = dict(env), dict(env)
+            second = self.statements(node.second, then_env)
+            third = self.statements(node.third, else_env)
+            env.clear()
+            env.update((name, value) for name, value in then_env.items()
+                       if else_env.get(name) == value)
+            return rebuild(node, first, second, third)
+
+        # lists, tuples, access...
+        first = self.child(node.first, env)
+        second = self.child(node.second, env)
+        return rebuild(node, first, second, self.child(node.third, env))
+
+
+    def binary (self, node):
+
+        """Folds the binary operation <node>, children already folded.
+        """
+
+        id = node.id
+        first, second = number(node.first), number(node.second)
+
+        if first is not None and second is not None:
+            if id == "/" and (second == 0 or (first == I64_MIN and second == -1)):
+                return node # runtime behaviour
+            return const(i64(int(operations[id](first, second))))
+
+        # algebraic identities, x is not a Const (strings are not numbers)
+        if first is None and node.first.id != "Const":
+            x = node.first
+            if (id in ("*", "/") and second == 1) or (id in ("+", "-") and second == 0):
+                return x
+            if id == "*" and second == 0 and pure(x) and self.integral(x):
+                return const(0)
+
+        if second is None and node.second.id != "Const":
+            x = node.second
+            if (id == "*" and first == 1) or (id == "+" and first == 0):
+                return x
+            if id == "*" and first == 0 and pure(x) and self.integral(x):
+                return const(0)
+
+        return node
+
+
+    def integral (self, node):
+
+        """True if the pure expression <node> is an int (or bool) in the folded function.
+        """
+
+        if self.scope is LAMBDA:
+            return False # untyped parameters
+        # no calls nor assignments in <node>: the walk does not grow the types
+        return Inference(self.program_types()).expr(node, self.scope) in (BOOL, INT)
+
+
+    def integral_name (self, name):
+
+        """True if the name <name> is an int (or bool) in the folded function: its
+        int values can be propagated. The types are flow insensitive, after x:5 the
+        name x is still float if it is assigned a float anywhere (x/2 is not 2).
+        """
+
+        if self.scope is LAMBDA:
+            return False
+        return self.program_types().of(self.scope, name) in (BOOL, INT)
+
+
+    def program_types (self):
+
+        # inference.Types of the program, inferred the first time
+        if self.types is None:
+            self.types = infer(self.nodes)
+        return self.types
+
+
+if __name__ == "__main__":
+
+    """Test. python optimizer.py
+    The folded programs print the same as without folding (main.py --jit),
+    programs that mix the types of their names.
+    """
+
+    import os
+    import sys
+    import subprocess
+    import tempfile
+
+    programs = [
+        "x:5\ny:x/2\nprint(y)\nx:0.5\nprint(x)\n",
+        "x:7\ny:x/2\nprint(y)\nx:x+0.5\nprint(x, \" \", y)\n",
+        "x:1.0/0\nprint(x*0)\nn:0\nprint(n*x)\n",
+        "a:3\nb:a*2\nif b > 5 then a:a/2.0 else a:1\nprint(a, \" \", b, \" \", b/4)\n",
+        "n:10\ni:0\nwhile i < 3 ::\n\tn:n/2\n\ti:i+1\nprint(n, \" \", i)\nn:0.5\n",
+        "f (x) -> x * 0\nk:2\nprint(f(2.5), \" \", f(k), \" \", k/4)\n",
+        "l:[1, 2]\nc:2\nprint(l*c, \" \", l*0, \" \", c/3)\nc:1.5\n",
+    ]
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    errors = 0
+    for program in programs:
+        with tempfile.NamedTemporaryFile("w", suffix=".sqy", delete=False) as f:
+            f.write(program)
+        try:
+            outputs = [subprocess.run([sys.executable, os.path.join(here, "main.py"), "--no-cache",
+                                       "--jit", f.name] + flags, capture_output=True,
+                                      text=True).stdout for flags in ([], ["--no-fold"])]
+        finally:
+            os.unlink(f.name)
+        if outputs[0] != outputs[1]:
+            errors += 1
+            print ("FAIL", repr(program), outputs)
+
+    print ("fold: %d programs, %d failed" % (len(programs), errors))
+    exit(1 if errors else 0)
@@ -0,0 +1,272 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 2018 Marcos V. Conde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+
+import os
+import sys
+from ctypes import CFUNCTYPE, c_int64, c_double, c_char_p, addressof, create_string_buffer
+from llvmlite import ir
+from sqyparser import Parser
+from myeval import Evaluator, free_names, i32_ty, i64_ty, double_ty, i8_ptr_ty, llvm_types
+from optimizer import assigned
+from inference import Types, Inference, FLOAT, infer
+from codegen import CodeGen, declare_printf, libc
+import instrument
+
+
+#--------------------------------------------------------------------------------------------
+# JIT REPL
+#
+# python main.py --repl --jit
+#
+# Each input is compiled to a new small LLVM module, added to the MCJIT engine of
+# one CodeGen and run at once; the code of the previous inputs is never compiled
+# again. The top level statements of input n go to the function __repl_n, which
+# returns the value of the last expression (printed by the console), i64 or double.
+#
+# The functions defined in the previous inputs are declared in the new module,
+# the engine resolves them to the code already compiled. The names assigned at the
+# top level are globals, defined by the first input that uses them and
+# declared in the next ones: their values stay in memory between inputs.
+#
+# The types (see inference) of each input are inferred with the types of the
+# previous ones; the types of the functions and globals already compiled do not
+# change, the values of other types are converted to them.
+#
+# A runtime error (division by zero, index out of range...) does not exit: the
+# entry function calls setjmp, the error stores its message in __repl_error and
+# longjmps back, and the input fails with ReplError. The process and the values of
+# the previous inputs go on.
+
+
+JMP_BUF_SIZE = 512 # bytes, more than the jmp_buf of the C library
+
+
+class ReplError(Exception):
+    pass
+
+
+class Repl:
+
+    """JIT compiler of the inputs of an interactive session.
+    opt_level -- 0..3, see CodeGen
+    """
+
+    def __init__ (self, opt_level=0):
+
+        self.codegen = CodeGen(name="repl", entry="__repl_0", opt_level=opt_level)
+        self.parser = Parser() # same scope for every input
+        self.functions = {} # name -> ir.FunctionType, defined by the previous inputs
+        self.globals = set() # names of the globals defined by the previous inputs
+        self.types = Types() # types of the previous inputs
+        self.count = 0
+        # runtime errors, see Evaluator.check
+        self.jmp_buf = create_string_buffer(JMP_BUF_SIZE)
+        self.error = c_char_p()
+        self.codegen.binding.add_symbol("__repl_jmp_buf", addressof(self.jmp_buf))
+        self.codegen.binding.add_symbol("__repl_error", addressof(self.error))
+
+
+    @property
+    def scope (self):
+
+        return self.parser.scope
+
+
+    def module (self):
+
+        """New ir.Module for the next input, with the functions and globals of
+        the previous inputs declared.
+        """
+
+        self.count += 1
+        module = ir.Module(name="repl%d" % self.count)
+        module.triple = self.codegen.module.triple
+        module.data_layout = self.codegen.module.data_layout
+        for name, ftype in self.functions.items():
+            ir.Function(module, ftype, name=name)
+        for name in self.globals:
+            ir.GlobalVariable(module, llvm_types[self.types.of(None, name)], name=name)
+        ir.GlobalVariable(module, ir.ArrayType(i64_ty, JMP_BUF_SIZE // 8), name="__repl_jmp_buf")
+        ir.GlobalVariable(module, i8_ptr_ty, name="__repl_error")
+        return module
+
+
+    def infer (self, nodes):
+
+        """Types of the input <nodes> with the types of the previous inputs,
+        the compiled functions and globals keep theirs.
+        """
+
+        types = infer(nodes, self.types.copy())
+        for name in self.functions:
+            params, ret = self.types.functions[name]
+            types.functions[name] = [list(params), ret]
+        for name in self.globals:
+            types.names[None][name] = self.types.of(None, name)
+        return types
+
+
+    def compile (self, program):
+
+        """LLVM module of the input <program> (text): ir.Module and the name of
+        its entry function, ret value of the last expression (0 if none), i64 or
+        double. Return (module, entry, has_value, names of the globals it defines,
+        its types).
+        """
+
+        with instrument.stage("parser", file="repl"):
+            tree, scope = self.parser.ast(program)
+        nodes = tree.first or []
+        types = self.infer(nodes)
+        # type of the last expression, on a copy: the walk would grow the globals
+        last = Inference(types.copy()).expr(nodes[-1], None) if nodes else None
+
+        module = self.module()
+        printf = declare_printf(module)
+        ret_ty = double_ty if last == FLOAT else i64_ty
+        entry = ir.Function(module, ir.FunctionType(ret_ty, []), name="__repl_%d" % self.count)
+        builder = ir.IRBuilder(entry.append_basic_block(name="entry"))
+
+        # a runtime error longjmps here: setjmp returns 1, the input ends
+        jmp_buf = module.get_global("__repl_jmp_buf")
+        setjmp = ir.Function(module, ir.FunctionType(i32_ty, [i8_ptr_ty]), name="_setjmp")
+        setjmp.attributes.add("returns_twice")
+        failed = builder.call(setjmp, [jmp_buf.bitcast(i8_ptr_ty)])
+        with builder.if_then(builder.icmp_signed("!=", failed, i32_ty(0)), likely=False):
+            builder.ret(ret_ty(0))
+
+        value = None
+        with instrument.stage("ir", file="repl"):
+            evaluator = Evaluator(scope, builder, module, printf, export=True, # next inputs
+                                  types=types)
+            evaluator.errors = (jmp_buf, module.get_global("__repl_error"))
+            names = assigned([node for node in nodes if node.id != "Function"])
+            for node in nodes:
+                if node.id == "Function":
+                    names |= free_names(node) & (names | self.globals)
+            defined = names - self.globals
+            for name in sorted(defined):
+                evaluator.define_global(name)
+            evaluator.globals |= self.globals
+            for node in nodes:
+                if node.id == "Function" and node.first.value in self.functions:
+                    raise ReplError("Function %r already defined" % node.first.value)
+            evaluator.declare_functions(nodes)
+            for node in nodes:
+                value = evaluator.eval(node)
+
+        has_value = isinstance(value, ir.Value) and isinstance(value.type, (ir.IntType, ir.DoubleType))
+        builder.ret(evaluator.cast(value, ret_ty) if has_value else ret_ty(0))
+        return module, entry.name, has_value, defined, types
+
+
+    def run (self, program):
+
+        """Compiles and runs the input <program>. Return the value of its
+        last expression, None if it has no value. ReplError if it fails at
+        runtime (the previous inputs are kept).
+        """
+
+        module, entry, has_value, defined, types = self.compile(program)
+        codegen = self.codegen
+        binding = codegen.binding
+
+        with instrument.stage("llvm parse", file="repl"):
+            mod = binding.parse_assembly(str(module))
+            mod.name = module.name
+            mod.verify()
+        codegen.optimize(mod)
+        with instrument.stage("jit", file="repl"):
+            codegen.engine.add_module(mod)
+            codegen.engine.finalize_object()
+
+        # the definitions are kept only if the module compiled
+        for func in module.functions:
+            if not func.is_declaration and func.name != entry:
+                self.functions[func.name] = func.ftype
+        self.globals |= defined
+        self.types = types
+
+        ret = c_double if module.get_global(entry).ftype.return_type == double_ty else c_int64
+        func = CFUNCTYPE(ret)(codegen.engine.get_function_address(entry))
+        sys.stdout.flush()
+        self.error.value = None
+        with instrument.stage("run", file="repl"):
+            try:
+                result = func()
+            finally:
+                libc.fflush(None) # printf writes to the C stdout buffer
+        if self.error.value is not None:
+            raise ReplError(self.error.value.decode("utf8"))
+        return result if has_value else None
+
+
+def console (opt_level=0):
+
+    """Interactive console, JIT compiled. See Repl.
+    -- commands:
+        exit
+        clear
+    """
+
+    repl = Repl(opt_level)
+
+    while True:
+        try:
+            expr = input (">> ")
+        except EOFError:
+            print ()
+            return
+        if expr == "exit": exit()
+        if expr == "clear":
+            os.system('clear')
+            continue
+
+        try:
+            result = repl.run(expr)
+        except Exception as error:
+            print (error.args[0] if error.args else error)
+            continue
+        if result is not None:
+            print (result)
+
+
+if __name__ == "__main__":
+
+    """Test. python repl.py
+    Runtime errors end the input, not the process: the next inputs run.
+    """
+
+    repl = Repl()
+    inputs = [("a : 7", 7), ("1/0", "error: division by zero"), ("a + 1", 8),
+              ("b : 0 - 9223372036854775807 - 1", -2**63), ("b / -1", "error: division overflow"),
+              ("f (x) -> a / x", None), ("f(0)", "error: division by zero"), ("f(2)", 3),
+              ("l : [4, 5]", None), ("l.2", "error: index out of range"), ("l / 0", "error: division by zero"),
+              ("l.1 + a", 12)]
+    errors = 0
+    for program, expected in inputs:
+        try:
+            result = repl.run(program)
+        except ReplError as error:
+            result = error.args[0]
+        if result != expected:
+            errors += 1
+            print ("FAIL", repr(program), result, "expected", expected)
+
+    print ("repl: %d inputs, %d failed" % (len(inputs), errors))
+    exit(1 if errors else 0)
@@ -0,0 +1,354 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 2018 Marcos V. Conde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+
+import io
+import re
+import bisect
+from sqyparser import Parser, symbol_table
+import instrument
+
+
+#--------------------------------------------------------------------------------------------
+# INCREMENTAL SESSION
+#
+# session = Session(source)
+# session.edit(start, end, "new text")     # or update(new source), append(text)
+# tree, scope = session.tree, session.scope
+# codegen = session.codegen()
+#
+# The source is split in top level statements (units) with a regex scan, no lexing:
+# a unit starts at a line that is not indented, outside brackets, strings and
+# comments, and that is not the "then"/"else" of an if. Each unit is lexed and
+# parsed alone (real newlines and tabs, as a file).
+#
+# After an edit only the units whose text changed are parsed again. A unit with the
+# same text is kept when the names it uses have the same values in the scope (and
+# are global or not as before), else it is parsed again: parsing depends on the
+# scope (assigned values, called functions, `global` names). The scope is rebuilt
+# replaying the changes of each kept unit, so it is the scope of a full parse.
+#
+# The LLVM IR of each function definition is kept in its own module (see
+# CodeGen.function_module) and linked into the program, only the functions of the
+# units parsed again, or using names whose value or type (see inference) changed,
+# are generated again. The types are inferred over the whole program.
+#
+# The nodes of the kept units are shared between versions of the tree: do not
+# change them (optimizer.fold copies the nodes it folds).
+
+
+# pieces of the source that hide newlines or change the nesting, same strings
+# and comments as the lexer rules
+split_regex = re.compile(r'"+[\s\S]+?"|#+[\s\S]+?#|[\[({]|[\])}]|\n(?!then\b|else\b)(?=\S)')
+
+words_regex = re.compile(r'[a-zA-Z_]\w*')
+
+MISSING = object() # name not in the scope
+
+
+def split (source):
+
+    """Start offsets of the top level statements of <source>.
+    """
+
+    starts = [0]
+    depth = 0
+    for match in split_regex.finditer(source):
+        c = match.group()[0]
+        if c == "\n":
+            if depth == 0 and match.start() + 1 > starts[-1]:
+                starts.append(match.start() + 1)
+        elif c in "[({":
+            depth += 1
+        elif c in "])}" and depth:
+            depth -= 1
+    return starts
+
+
+class Names(dict):
+
+    """Scope.names that records the names written.
+    """
+
+    def __init__ (self, *args):
+
+        dict.__init__(self, *args)
+        self.written = set()
+
+    def __setitem__ (self, name, value):
+
+        self.written.add(name)
+        dict.__setitem__(self, name, value)
+
+
+class Unit:
+
+    """A top level statement of the session.
+    start, end -- offsets in the source
+    text -- its source
+    nodes -- its top level nodes (usually one)
+    words -- identifiers in its text
+    env -- {word: (value in the scope, global)} before it was parsed
+    effects -- {name: value} written in the scope by it
+    symbols -- `global` names declared by it
+    modules -- (node, LLVM module, {word: (value, types)}) of its functions, see Session.codegen
+    """
+
+    __slots__ = ("start", "end", "text", "nodes", "words", "env", "effects", "symbols", "modules")
+
+    def __init__ (self, text):
+
+        self.text = text
+        self.start = self.end = 0
+        self.words = frozenset(words_regex.findall(text))
+        self.nodes = []
+        self.env = {}
+        self.effects = {}
+        self.symbols = {}
+        self.modules = []
+
+    def __repr__ (self):
+
+        return "Unit(%d:%d, %r)" % (self.start, self.end, self.nodes)
+
+
+class Session:
+
+    """Incremental front end of a program edited many times (editor, console).
+    source -- initial source
+    name -- module name for CodeGen
+    engine -- lexer engine, see lexer.lexer
+    """
+
+    def __init__ (self, source="", name="session", engine="regex"):
+
+        self.name = name
+        self.parser = Parser(engine=engine)
+        self.source = ""
+        self.units = []
+        self._tree = None
+        if source:
+            self.update(source)
+
+
+    @property
+    def scope (self):
+
+        return self.parser.scope
+
+
+    @property
+    def tree (self):
+
+        """Module node with the statements of every unit.
+        """
+
+        if self._tree is None:
+            self._tree = symbol_table["Module"]()
+            self._tree.first = [node for unit in self.units for node in unit.nodes]
+        return self._tree
+
+
+    def edit (self, start, end, text):
+
+        """Replaces the source between offsets <start> and <end> by <text>.
+        Return the units parsed again, see update.
+        """
+
+        return self.update(self.source[:start] + text + self.source[end:])
+
+
+    def append (self, text):
+
+        """Adds <text> as new statements at the end (console).
+        Return the units parsed again, see update.
+        """
+
+        if self.source and not self.source.endswith("\n"):
+            text = "\n" + text
+        if not text.endswith("\n"):
+            text += "\n" # the next line does not change this unit
+        return self.update(self.source + text)
+
+
+    def update (self, source):
+
+        """New version of the whole source. Parses again only the units that
+        changed or depend on changed names. Return the list of units parsed.
+        On errors the session keeps the previous version.
+        """
+
+        starts = split(source)
+        ends = starts[1:] + [len(source)]
+
+        old = {} # text -> old units with that text, in order
+        for unit in self.units:
+            old.setdefault(unit.text, []).append(unit)
+
+        parser = self.parser
+        scope, symbols = parser.scope.names, parser.symbols.maps[0]
+        parser.scope.names = names = Names()
+        parser.symbols.maps[0] = {}
+
+        units, parsed = [], []
+        try:
+            for start, end in zip(starts, ends):
+                text = source[start:end]
+                candidates = old.get(text)
+                unit = candidates.pop(0) if candidates else None
+                if unit is None or not self.valid(unit):
+                    unit = self.parse(text)
+                    parsed.append(unit)
+                else:
+                    names.update(unit.effects)
+                    parser.symbols.maps[0].update(unit.symbols)
+                units.append(unit)
+        except BaseException:
+            parser.scope.names, parser.symbols.maps[0] = scope, symbols
+            raise
+
+        for unit, start, end in zip(units, starts, ends):
+            unit.start, unit.end = start, end
+        instrument.count("units parsed", len(parsed))
+        self.source = source
+        self.units = units
+        self._tree = None
+        return parsed
+
+
+    def valid (self, unit):
+
+        """True if the scope has the values that <unit> saw when it was parsed.
+        """
+
+        names, symbols = self.parser.scope.names, self.parser.symbols.maps[0]
+        for word, (value, declared) in unit.env.items():
+            if names.get(word, MISSING) is not value and names.get(word, MISSING) != value:
+                return False
+            if (word in symbols) != declared:
+                return False
+        return True
+
+
+    def parse (self, text):
+
+        """New unit of the statement <text>, parsed in the current scope.
+        """
+
+        unit = Unit(text)
+        parser = self.parser
+        names, symbols = parser.scope.names, parser.symbols.maps[0]
+        unit.env = {word: (names.get(word, MISSING), word in symbols) for word in unit.words}
+
+        names.written = set()
+        declared = set(symbols)
+        with instrument.stage("parser", file=self.name):
+            tree, scope = parser.ast(io.StringIO(text))
+        unit.nodes = tree.first
+        unit.effects = {name: names[name] for name in names.written}
+        unit.symbols = {name: symbols[name] for name in symbols if name not in declared}
+        return unit
+
+
+    def unit_at (self, offset):
+
+        """Unit of the source at <offset>, None if there are no units.
+        """
+
+        if not self.units:
+            return None
+        i = bisect.bisect_right([unit.start for unit in self.units], offset) - 1
+        return self.units[max(i, 0)]
+
+
+    def codegen (self, **options):
+
+        """New CodeGen (<options>, see CodeGen) with the program: the top level
+        statements in the entry function and the functions linked from their
+        own modules, generated only if their unit changed.
+        """
+
+        from codegen import CodeGen
+        from inference import infer
+
+        options.setdefault("export", True) # globals and functions of other modules
+        codegen = CodeGen(name=self.name, **options)
+        names = self.scope.names
+        with instrument.stage("types", file=self.name):
+            types = infer(self.tree.first)
+        top, linked = [], []
+
+        for unit in self.units:
+            functions = [node for node in unit.nodes if is_function(node)]
+            top.extend(node for node in unit.nodes if not is_function(node))
+            if not functions:
+                unit.modules = []
+                continue
+
+            # the body uses the last value of its names in the scope, and their types
+            env = {word: (names.get(word, MISSING), types.names[None].get(word),
+                          types.functions.get(word)) for word in unit.words}
+            if len(unit.modules) != len(functions) or any(
+                    not same(module_env, env) for node, module, module_env in unit.modules):
+                with instrument.stage("ir", file=self.name):
+                    unit.modules = [(node, codegen.function_module(node, self.scope, types), env)
+                                    for node in functions]
+                instrument.count("functions generated", len(functions))
+
+            for node, module, module_env in unit.modules:
+                codegen.link_in(module)
+                linked.append(node)
+
+        # the entry module declares the linked functions (signatures of <types>)
+        tree = symbol_table["Module"]()
+        tree.first = top
+        codegen.generate(tree, self.scope, linked, types)
+        return codegen
+
+
+def is_function (node):
+
+    # function definition, print (...) -> ... is a print
+    return node.id == "Function" and getattr(node.first, "value", None) != "print"
+
+
+def same (env, other):
+
+    for word, value in env.items():
+        if other.get(word, MISSING) is not value and other.get(word, MISSING) != value:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+
+    """Test. python session.py
+    Calls to the functions linked from their own modules: from the top level,
+    from other function and after an edit.
+    """
+
+    session = Session("a : 5\nf (x) -> x + a\ng (x) -> f(x) * 2\nb : f(1)\nh (x) -> b + g(x)\n")
+    codegen = session.codegen()
+    codegen.run() # a and b
+    assert codegen.call("f", 1) == 6, "f(1)"
+    assert codegen.call("h", 1) == 18, "h(1)" # b is f(1), top level call
+
+    session.edit(0, len("a : 5"), "a : 7")
+    codegen = session.codegen()
+    codegen.run()
+    assert codegen.call("h", 1) == 24, "h(1) after the edit"
+    print ("session: linked calls ok")
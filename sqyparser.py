@@ -20,10 +20,8 @@
 import sys
 import re
 import json
-import time
-import visualiser as visu
-from statistics import mean 
 import os
+from collections import ChainMap
 from myeval import Eval
 
 
@@ -136,19 +134,24 @@ def new_space ():
     space.parent = s
     return space;
 
-SCOPE = Scope()
+#--------------------------------------------------------------------------------------------
 
 
-#--------------------------------------------------------------------------------------------
+# attributes of the nodes (__slots__, no __dict__ per node: large programs)
+# number -- int value of a Const, cached by myeval
+node_slots = ("first", "second", "third", "id", "arity", "reserved", "name", "value",
+              "solve", "number")
 
 
-def symbol(id, bp=0):
+def symbol(id, bp=0, table=symbol_table):
 
     """Creates a new class for token <id> (if necessary)
 
         Param:
         id -- token's id or symbol
         bp -- binding power
+        table -- where the class is registered, symbol_table by default.
+            A parser registers its own `global` names in Parser.symbols
 
         Return:
         Protoclass -- Symbol <id> Class. Sample: token's id = "+" 
@@ -157,7 +160,7 @@ def symbol(id, bp=0):
     """
 
     try:
-        Protoclass = symbol_table[id]
+        Protoclass = table[id]
     except KeyError:
 
         class Protoclass:
@@ -170,20 +173,26 @@ def symbol(id, bp=0):
             # Class attributes
 
             lbp = bp
-            value = id
+            __slots__ = node_slots
+
+            # standard nud/led, parsed by Parser.parse without recursion
+            prefix_bp = None # prefix(): bp of the operand
+            infix_rbp = None # infix(), infix_r(): rbp of the right operand
+            assign = False # assigment(): rbp is lbp-1
 
 
             def __init__ (self):
 
                 self.first = self.second = self.third = None
                 self.id = id
+                self.value = id
                 self.arity = None
                 self.reserved = False 
                 try : self.name = names_map[self.id]
                 except KeyError: self.name= self.id    
 
 
-            def nud (self):
+            def nud (self, parser):
                 """Default nud method.
                 Check prefix
                 """
@@ -192,7 +201,7 @@ def symbol(id, bp=0):
                     raise IndentationError ('Incorrect use of TABS.')
 
 
-            def led (self,left):
+            def led (self, parser, left):
 
                 """Default led method.
                 Check infix and infix_r.
@@ -201,21 +210,10 @@ def symbol(id, bp=0):
                 raise SyntaxError("Syntax error (%r)." % self.id)
 
 
-            def __repr__(self):
-                               
-                out = [self.first, self.second, self.third]
-                out = map(str, filter(None, out))
-
-                if self.arity == 1:
-                    return self.name +"("+ "".join(out) + ")"
-
-                elif self.id == "Name" or self.id == "Const":
-                    return "%s (%s)" % (self.id, self.value)
-
-                return self.name + "("+ ",".join(out) + ")"
+            __repr__ = node_repr
 
         Protoclass.__name__ = "SymClass_" + id
-        symbol_table[id] = Protoclass
+        table[id] = Protoclass
 
     else:
         Protoclass.lbp = max(bp, Protoclass.lbp)
@@ -224,35 +222,48 @@ def symbol(id, bp=0):
 
 
 
-def advance (id=None):
-
-    """Genera la instancia el token siguiente según su correspondiente clase.
-    Permite comparar el id del siguiente con un id pasado por párametro.
+def node_repr(node):
 
-    Párametros:
-    id -- id del token que vamos a instanciar (next token). 
-        Si id = None simplemente se instanciará el siguiente token.
-        Si id tiene un valor, se compmrobará antes de instanciar.
+    """Text of the AST <node> (Protoclass.__repr__), without recursion:
+        Name (a) , Const (5) , Add(Name (a),Const (5)) , UnarySub(Const (5))
     """
 
-    global token
-    if id and token.id != id:
-        raise SyntaxError("Expected %r" % id)
+    out = []
+    stack = [("str", node)] # (how, object) to write, last first
 
-    if token.id == "(end)": pass
-    else:
-        token = next()
+    while stack:
+        how, obj = stack.pop()
 
+        if how == "text":
+            out.append(obj)
 
-def ignore (id=None):
+        elif isinstance(obj, list):
+            # str(list) -> repr of the items
+            stack.append(("text", "]"))
+            for i in range(len(obj)-1, -1, -1):
+                stack.append(("repr", obj[i]))
+                if i: stack.append(("text", ", "))
+            stack.append(("text", "["))
 
-    """ MOD of advance function. Ignores token <id>, advance until sees token different than <id>
-    """
+        elif not hasattr(obj, "nud"):
+            out.append(repr(obj) if how == "repr" else str(obj))
+
+        elif obj.__class__.__repr__ is not node_repr:
+            out.append(repr(obj)) # own __repr__ (Module)
 
-    global token
-    while token.id == id:
-        token = next()
-    if token.id == "(end)": pass
+        elif obj.arity != 1 and (obj.id == "Name" or obj.id == "Const"):
+            out.append("%s (%s)" % (obj.id, obj.value))
+
+        else:
+            children = list(filter(None, [obj.first, obj.second, obj.third]))
+            sep = "" if obj.arity == 1 else ","
+            stack.append(("text", ")"))
+            for i in range(len(children)-1, -1, -1):
+                stack.append(("str", children[i]))
+                if i: stack.append(("text", sep))
+            stack.append(("text", obj.name + "("))
+
+    return "".join(out)
 
 
 def add_method(symbol_class):
@@ -266,6 +277,32 @@ def add_method(symbol_class):
 
 
 
+prefix_names = {"+":"UnaryAdd", "-":"UnarySub","not":"Not"}
+
+
+def prefix_node(self, first):
+
+    """Completes the prefix node <self> with its operand <first>.
+    """
+
+    self.first = first
+    self.name = prefix_names[self.id]
+    self.solve = self.first
+    self.arity = 1
+    return self
+
+
+def infix_node(self, left, second):
+
+    """Completes the infix node <self>: left <self> second.
+    """
+
+    self.first = left
+    self.second = second
+    self.arity = 2
+    return self
+
+
 def prefix(id, bp):
 
     """
@@ -274,35 +311,27 @@ def prefix(id, bp):
     Examples: +,-, not => UnaryAdd, UnaryMinus, Not
     """
 
-    names = {"+":"UnaryAdd", "-":"UnarySub","not":"Not"}
-    def nud(self):
-        self.first = parse(bp)
-        self.name = names[self.id]
-        self.solve = self.first
-        self.arity = 1
-        return self
+    def nud(self, parser):
+        return prefix_node(self, parser.parse(bp))
     symbol(id).nud=nud
+    symbol(id).prefix_bp = bp
 
 
 def infix(id,bp):
     
-    def led(self, left):
-        self.first = left
-        self.second = parse(bp)
-        self.arity = 2
-        return self
+    def led(self, parser, left):
+        return infix_node(self, left, parser.parse(bp))
     symbol(id,bp).led=led
+    symbol(id).infix_rbp = bp
  
 
 
 # special infix case: right associative
 def infix_r(id,bp):
-    def led(self, left):
-        self.first = left
-        self.second = parse(bp-1) # solves right associative
-        self.arity = 2
-        return self
+    def led(self, parser, left):
+        return infix_node(self, left, parser.parse(bp-1)) # solves right associative
     symbol(id,bp).led=led
+    symbol(id).infix_rbp = bp-1
 
 
 
@@ -362,7 +391,7 @@ symbol("Module")
 # so we may have to change them.
 
 
-symbol("Const").nud = lambda self: self
+symbol("Const").nud = lambda self, parser: self
 
 
 #symbol("Const").solve = lambda self: self.value
@@ -382,18 +411,18 @@ def nud (self):
         advance()
         return self
 """
-symbol("Name").nud = lambda self: self # !!!
+symbol("Name").nud = lambda self, parser: self # !!!
 
 
 #--------------------------------------------------------------------------------------------
 
-def constant(id,value):
-    @add_method(symbol(id))
-    def nud(self):
+def constant(id,value,table=symbol_table):
+    def nud(self, parser):
         self.id = self.name = "Const"
         self.value = value
-        SCOPE.reserve(id,value)
+        parser.scope.reserve(id,value)
         return self
+    symbol(id,0,table).nud = nud
 
 constant("null",None)
 constant("True",1)
@@ -404,29 +433,45 @@ constant("pi", 3.141592653589793)
 
 # global Name -> accessible from any SCOPE
 @add_method(symbol("global"))
-def nud (self):
-    self.first = token # var
-    advance("Name")
-    constant(self.first.value,None)
+def nud (self, parser):
+    self.first = parser.token # var
+    parser.advance("Name")
+    constant(self.first.value,None,parser.symbols.maps[0])
     return self
 
 
-def assigment (self,left):
+def assigment (self,parser,left):
     #print ("Estoy en assigment")
+    return assign_node(self, parser, left, parser.parse(self.lbp-1))
+
+
+def assign_node (self, parser, left, second):
+
+    """Completes the assignment <self>: left : second, and reserves the name
+    with its value in the scope of <parser>.
+    """
+
     self.first = left;
-    self.second = parse(self.lbp-1)
+    self.second = second
     self.arity = 2
+    scope = parser.scope
     try:
-        SCOPE.reserve(self.first.value,Eval(self.second,SCOPE))
+        if parser.assigned is not None and parser.assigned[0] is second:
+            value = parser.assigned[1] # a:b:c:..., the value of b:c:... is known
+        else:
+            value = Eval(self.second,scope)
+        scope.reserve(self.first.value,value)
     except:
-        SCOPE.reserve(self.first.value,"test-mode")
-    #SCOPE.reserve(self.first.value,"test-mode")
+        value = "test-mode"
+        scope.reserve(self.first.value,value)
+    parser.assigned = (self, value)
     #print ("son:",self.first.value,Eval(self.second))
-    #print (SCOPE)
+    #print (scope)
     return self
 
 symbol(":").led = assigment
 symbol(":=").led = assigment
+symbol(":").assign = symbol(":=").assign = True
 
 
 # a <- { elem1: int, elem2: Dub, elem3:string}  => is structure a 
@@ -438,22 +483,22 @@ symbol(":=").led = assigment
 # expression_list ::=  [expressions...]
 
 @add_method(symbol("["))
-def nud(self):
+def nud(self, parser):
     self.first = []
-    if token.id != "]":
+    if parser.token.id != "]":
         while 1:
-            ignore(NEWLINE);ignore(INDENT);ignore(TAB)
+            parser.ignore(NEWLINE);parser.ignore(INDENT);parser.ignore(TAB)
             #assert token.id == "Const"
             #self.first.append(token)
             #advance()
             #if token.id == "]":break
-            self.first.append(parse()) # check parse is an expression
+            self.first.append(parser.parse()) # check parse is an expression
 
-            ignore(NEWLINE);ignore(INDENT);ignore(TAB)
-            if token.id != ",": break
-            advance(",")
+            parser.ignore(NEWLINE);parser.ignore(INDENT);parser.ignore(TAB)
+            if parser.token.id != ",": break
+            parser.advance(",")
 
-    advance("]")
+    parser.advance("]")
     self.arity = 1
     self.name = "List"
     return self
@@ -464,18 +509,18 @@ def nud(self):
 # expression_tuple ::=  (expressions...)
 
 @add_method(symbol("("))
-def nud(self):
+def nud(self, parser):
     self.first = []
-    if token.id != ")":
+    if parser.token.id != ")":
         while 1:
-            if token.id == ")":
+            if parser.token.id == ")":
                 break
             #self.first.append(token)
-            self.first.append(parse())
-            if token.id != ",":
+            self.first.append(parser.parse())
+            if parser.token.id != ",":
                 break
-            advance(",")
-    advance(")")
+            parser.advance(",")
+    parser.advance(")")
 
     if len(self.first) > 1:
         self.name = "Tuple"
@@ -494,12 +539,12 @@ def nud(self):
 # !!! list,tuples,dic & types
 
 @add_method(symbol("."))
-def led(self, left):
-    if token.id != "Const":
+def led(self, parser, left):
+    if parser.token.id != "Const":
         SyntaxError("Expected numeric index.")
     self.first = left
-    self.second = token
-    advance()
+    self.second = parser.token
+    parser.advance()
     return self
 
 
@@ -512,24 +557,24 @@ def led(self, left):
 
 
 @add_method(symbol("lambda"))
-def nud(self):
+def nud(self, parser):
     self.first = [] # arg
-    if token.id != "::":
-        parameter_list(self.first)
+    if parser.token.id != "::":
+        parameter_list(parser,self.first)
     if len(self.first )==0:
         raise SyntaxError ("Bad lambda, no arguments")
-    advance("::")
-    self.second = parse() # tiene que ser una expression
+    parser.advance("::")
+    self.second = parser.parse() # tiene que ser una expression
     return self
 
 
-def parameter_list(list):
+def parameter_list(parser,list):
     while 1:
-        if token.id != "Name":
+        if parser.token.id != "Name":
             SyntaxError("Expected a parameter Name.")
-        list.append(token)
-        advance()
-        if token.id == "::": break
+        list.append(parser.token)
+        parser.advance()
+        if parser.token.id == "::": break
 
 
 #--------------------------------------------------------------------------------------------
@@ -553,22 +598,22 @@ SEMICOLON = ";"
 end_stmt = [INDENT,"(end)",SEMICOLON]
 
 
-def statement (end_block):
+def statement (parser,end_block):
 
     """Parsea un statement hasta llegar a <end_stmt> o <end_block>
     """
 
-
+    token = parser.token
     if (token.id in ["while","if","else","then"]):
-        t = token
-        advance()
-        return t.nud()
+        parser.advance()
+        return token.nud(parser)
 
-    statement = parse()
+    statement = parser.parse()
 
+    token = parser.token
     if token.id in end_block:
         pass
-    elif token.id in end_stmt: advance(token.id)
+    elif token.id in end_stmt: parser.advance(token.id)
     else:
         raise SyntaxError ("Expected %r" % end_stmt)
 
@@ -576,7 +621,7 @@ def statement (end_block):
 		
 
 
-def statement_list (end_block=[NEWLINE,"(end)"]):
+def statement_list (parser,end_block=[NEWLINE,"(end)"]):
     
     """Parsea statements hasta llegar a <end_block>.
         Return:
@@ -589,10 +634,10 @@ def statement_list (end_block=[NEWLINE,"(end)"]):
 
     while 1:
 
-        if token.id in end_block :
+        if parser.token.id in end_block :
             break
-        ignore(INDENT)
-        ignore(TAB)
+        parser.ignore(INDENT)
+        parser.ignore(TAB)
 
         """
         for k in range (1,level):
@@ -602,26 +647,26 @@ def statement_list (end_block=[NEWLINE,"(end)"]):
                 raise IndentationError('Expected TAB but found "%s" '% token)
         """
 
-        s = statement(end_block) # un solo statement
+        s = statement(parser,end_block) # un solo statement
         if s:
             stmt.append(s)
-        ignore(INDENT)
+        parser.ignore(INDENT)
 
     if len(stmt) == 0: return None
     elif len(stmt) == 1: return [stmt[0]] # s
     else: return stmt
 
 
-def block (key=None):
-    t = token
-    advance(key)
-    ignore(INDENT) 
-    return t.nud()
+def block (parser,key=None):
+    t = parser.token
+    parser.advance(key)
+    parser.ignore(INDENT) 
+    return t.nud(parser)
 
 
 @add_method(symbol("::"))
-def nud (self):
-    a = statement_list()
+def nud (self, parser):
+    a = statement_list(parser)
     return a
 
 
@@ -635,21 +680,21 @@ FUNCTION_SKELETON =
 
 
 @add_method(symbol("("))
-def led(self,left):
+def led(self,parser,left):
 
     self.first = left
     self.second = []
     arg = []
     ret = []
 
-    if token.id != ")":
+    if parser.token.id != ")":
         while 1:
-            if token.id == ")":break
-            arg.append(parse())
-            if token.id != ",":break
-            advance(",")
+            if parser.token.id == ")":break
+            arg.append(parser.parse())
+            if parser.token.id != ",":break
+            parser.advance(",")
 
-    advance(")")
+    parser.advance(")")
     self.second.append(arg)
 
     # sería en el scope de la función no en el general
@@ -660,7 +705,7 @@ def led(self,left):
         SCOPE.reserve(name,"undefined")
     """
 
-    if self.first.value in SCOPE.names:
+    if self.first.value in parser.scope.names:
         #funcall
         #print (self.first)
         self.third = None   
@@ -674,7 +719,7 @@ def led(self,left):
     #print (SCOPE)
     
     try:
-        advance ("->")
+        parser.advance ("->")
     except:
         self.third = None   
         self.arity = "2"
@@ -684,13 +729,13 @@ def led(self,left):
     #t = token
     #advance()
 
-    ret.append(parse())
+    ret.append(parser.parse())
     #ret.append(t.nud())
     self.second.append(ret)
 
     # statement
     try :
-        self.third = block("::")
+        self.third = block(parser,"::")
         self.arity = "statement"
         
     except SyntaxError:
@@ -705,14 +750,11 @@ def led(self,left):
 #--------------------------------------------------------------------------------------------
 # WHILE statement
 
-symbol("while").arity = "statement"
-symbol("while").name = "While_stmt"
-
 @add_method(symbol("while"))
-def nud (self):
+def nud (self, parser):
 
-    self.first = parse(20)
-    self.second = block("::")
+    self.first = parser.parse(20)
+    self.second = block(parser,"::")
 
     if self.second == None:
         raise WhileError ('While Statement Error. No statement found after ::')
@@ -722,38 +764,39 @@ def nud (self):
 #--------------------------------------------------------------------------------------------
 # IF-THEN-ELSE statement
 
-symbol("if").arity = "statement"
-
 @add_method(symbol("then"))
-def nud (self):
-    stm = statement_list(["(end)","else",NEWLINE])
+def nud (self, parser):
+    stm = statement_list(parser,["(end)","else",NEWLINE])
     return stm
 
 
 @add_method(symbol("else"))
-def nud (self):
-    a = statement_list()
+def nud (self, parser):
+    a = statement_list(parser)
     return a
 
 
 @add_method(symbol("if"))
-def nud(self):
-    self.first = parse(20)
-    ignore(NEWLINE); ignore(INDENT)
+def nud(self, parser):
+    self.first = parser.parse(20)
+    parser.ignore(NEWLINE); parser.ignore(INDENT)
 
     try :
-        self.second = block("then")
+        self.second = block(parser,"then")
     except:
-        raise IfError ('Expected "then" but found "%s" '% token)
+        raise IfError ('Expected "then" but found "%s" '% parser.token)
 
     if self.second == None :
         raise IfError ('IF-THEN Statement Error. No Statement found after "then"')
 
-    ignore(NEWLINE)
-    if token.id == "else":
-        self.third = block("else")
+    newline = parser.token
+    parser.ignore(NEWLINE)
+    if parser.token.id == "else":
+        self.third = block(parser,"else")
         if self.third == None :
             raise IfError('IF-THEN-ELSE Statement Error. No Statement found after "else"')
+    elif newline.id == NEWLINE:
+        parser.back(newline) # no else, the newline ends the statement
 
     self.arity = "statement"
     return self
@@ -762,33 +805,33 @@ def nud(self):
 #--------------------------------------------------------------------------------------------
 # MODULE/PROGRAM statement
 
-def module ():
+def module (parser):
     program = []
 
-    ignore (NEWLINE)
-    if token.id != "(end)":
+    parser.ignore (NEWLINE)
+    if parser.token.id != "(end)":
         while 1:
-            ignore (NEWLINE)
-            #ignore (INDENT)
-            ignore (SEMICOLON)
-            if token.id == "(end)": break
-            if token.id == NEWLINE: ignore(NEWLINE)
-            program.append(parse())
-
-    advance("(end)")
+            parser.ignore (NEWLINE)
+            #parser.ignore (INDENT)
+            parser.ignore (SEMICOLON)
+            if parser.token.id == "(end)": break
+            if parser.token.id == NEWLINE: parser.ignore(NEWLINE)
+            program.append(parser.parse())
+
+    parser.advance("(end)")
     return program
 
 
 @add_method(symbol("Module"))
-def nud (self):
-    self.first = module()
+def nud (self, parser):
+    self.first = module(parser)
     return self
 
 
 @add_method(symbol("Module"))
 def __repr__ (self):
     out = self.first
-    out = map(str, out)
+    out = map(node_repr, out)
     return "Module [ \n\n\t"+ "\n\n\t".join(out) +"\n]"
 
 
@@ -796,76 +839,282 @@ def __repr__ (self):
 #--------------------------------------------------------------------------------------------
 # LEXER CALL
 
-def tokenize(program):
+def make_atom(id, value, symbols=symbol_table, leaves=None):
 
-    """
-    # Genera una instancia 'atom' para la clase asociada al token obtenido mediante tokenize_python
-    # (tokenize module). Ver symbol_table.
+    """Instancia 'atom' de la clase asociada al token (id, value). Ver symbol_table.
+    <symbols> -- tabla de simbolos, Parser.symbols incluye sus nombres `global`
+    <leaves> -- {(id, value): atom}, los Const y Name iguales son el mismo atom
+        (nunca se modifican), ver Parser(intern=...)
     """
 
-    from lexer import lexer
+    if leaves is not None and (id == "number" or id == "string" or
+                               (id == "Name" and value not in symbols)):
+        try:
+            return leaves[id, value]
+        except KeyError:
+            atom = leaves[id, value] = make_atom(id, value, symbols)
+            return atom
 
-    for token in lexer(program):
+    if id == "number" or id == "string":
+    	Clase_token = symbols["Const"]
+    	atom = Clase_token()
+    	atom.value = value
 
-    	if token.id == "number" or token.id == "string":
-    		Clase_token = symbol_table["Const"]
+    else:
+
+    	Clase_token = symbols.get(value)
+
+    	if Clase_token:
     		atom = Clase_token()
-    		atom.value = token.value
 
+    	elif id == "Name":
+
+    		Clase_token = symbols[id]
+    		atom = Clase_token()
+    		atom.value = value
     	else:
+    		raise SyntaxError("Unknown operator (%r)" % value)
+
+    return atom
+
 
-    		Clase_token = symbol_table.get(token.value)
+def copy_node(node):
+
+    """New node of the class of <node> with its attributes (first, second...
+    are the same objects, not copied).
+    """
 
-    		if Clase_token:
-    			atom = Clase_token()
+    new = object.__new__(node.__class__)
+    new.first, new.second, new.third = node.first, node.second, node.third
+    new.id, new.arity, new.reserved = node.id, node.arity, node.reserved
+    new.name, new.value = node.name, node.value
+    if node.arity == 1 and node.id in prefix_names:
+        new.solve = node.solve # see prefix_node
+    return new
 
-    		elif token.id == "Name":
 
-    			Clase_token = symbol_table[token.id]
-    			atom = Clase_token()
-    			atom.value = token.value
-    		else:
-    			raise SyntaxError("Unknown operator (%r)" % token.value)
+def tokenize(program, symbols=symbol_table, engine="regex", leaves=None):
 
-    	yield atom
+    """
+    # Genera una instancia 'atom' para la clase asociada al token obtenido mediante tokenize_python
+    # (tokenize module). Ver symbol_table.
+    # <program> puede ser un lexer.TokenBuffer, se lee directamente sin crear lexer.Token
+    # <engine> -- motor del lexer, ver lexer.lexer
+    # <leaves> -- dict, Const y Name compartidos, ver make_atom
+    """
+
+    from lexer import lexer, TokenBuffer
+
+    if isinstance(program, TokenBuffer):
+        for id, value in program.items():
+            yield make_atom(id, value, symbols, leaves)
+    else:
+        for token in lexer(program, engine):
+            yield make_atom(token.id, token.value, symbols, leaves)
 
 
 #--------------------------------------------------------------------------------------------
 # PARSER ENGINE
 
 
-def parse(rbp=0):
+class Parser:
 
-    """
-    Pratt parser implementation.
-    See "Top Down Operator Precedence" (section 3: Implementation, pág 47)
+    """Pratt parser. Each instance holds its own token cursor, scope and
+    `global` names, so parsers do not share state: many of them can run at the
+    same time (threads or processes) and one parser can be reused for many programs.
+
+    nud and led methods of the symbols receive the parser:
+        nud(self, parser) , led(self, parser, left)
+
+    Params:
+    scope -- Scope for the names of the programs. A new one by default.
+        Reusing the parser keeps the scope (console), see reset().
+    engine -- lexer engine, see lexer.lexer
+    intern -- None, "leaves" or "expressions". Nodes shared inside a program:
+        "leaves" -- equal Const and Name nodes are one node, see make_atom
+        "expressions" -- also the operators over shared operands (hash-consing):
+            a+1 ... (a+1)*2 use the same Add(Name (a),Const (1)), see share()
+        Shared nodes must not be changed after parsing (optimizer.fold copies them).
     """
 
-    global token
-    t = token
-    advance()
-    left = t.nud()
+    interning = (None, "leaves", "expressions")
 
-    while rbp < token.lbp:
-        t = token
-        advance()
-        left = t.led(left)
-    return left
+    def __init__ (self, scope=None, engine="regex", intern=None):
+
+        if intern not in self.interning:
+            raise ValueError("Unknown intern mode %r" % intern)
+        self.scope = Scope() if scope is None else scope
+        self.symbols = ChainMap({}, symbol_table) # `global` names, see constant()
+        self.engine = engine
+        self.intern = intern
+        self.leaves = None # {(id, value): atom}, see make_atom
+        self.expressions = None # {(id, arity, operands): node}, see share
+        self.shared = None # nodes in expressions
+        self.token = None
+        self.next = None
+        self.assigned = None # (last assignment, value), see assign_node
 
 
+    def reset (self):
+
+        """New scope and `global` names, as a new parser.
+        """
 
-def ast(program):
+        self.scope = Scope()
+        self.symbols = ChainMap({}, symbol_table)
+
+
+    def ast (self, program):
+
+        """Creates AST using Pratt's Parser. Return (tree, scope)
+        """
+
+        # the shared nodes of one program, released with its tree
+        self.leaves = {} if self.intern else None
+        self.expressions = {} if self.intern == "expressions" else None
+        self.shared = set()
+        self.next = tokenize(program, self.symbols, self.engine, self.leaves).__next__
+        self.token = self.next()
+        try:
+            tree = self.parse()
+        finally:
+            self.next = None # release the lexer (and the file)
+            self.leaves = self.expressions = self.shared = None
+        return tree,self.scope
+
+
+    def advance (self, id=None):
+
+        """Genera la instancia el token siguiente según su correspondiente clase.
+        Permite comparar el id del siguiente con un id pasado por párametro.
+
+        Párametros:
+        id -- id del token que vamos a instanciar (next token). 
+            Si id = None simplemente se instanciará el siguiente token.
+            Si id tiene un valor, se compmrobará antes de instanciar.
+        """
+
+        if id and self.token.id != id:
+            raise SyntaxError("Expected %r" % id)
+
+        if self.token.id == "(end)": pass
+        else:
+            self.token = self.next()
+
+
+    def back (self, token):
+
+        """Makes <token> (already read) the current token again,
+        the current one comes after it.
+        """
+
+        following, next = self.token, self.next
+
+        def resume ():
+            self.next = next
+            return following
+
+        self.token, self.next = token, resume
+
+
+    def ignore (self, id=None):
+
+        """ MOD of advance function. Ignores token <id>, advance until sees token different than <id>
+        """
+
+        while self.token.id == id:
+            self.token = self.next()
+
+
+    def parse (self, rbp=0):
+
+        """
+        Pratt parser implementation.
+        See "Top Down Operator Precedence" (section 3: Implementation, pág 47)
+
+        The operand of the prefix, infix and assignment operators (prefix_bp,
+        infix_rbp, assign) is parsed with an explicit stack instead of a recursive
+        call: long chains like 1+1+...+1, a**b**...**c, a:b:...:5 or - - - 1
+        do not reach the recursion limit. The other nud and led are called.
+        """
+
+        stack = [] # (operator, left or None for prefix, rbp of the caller)
+
+        while True:
+
+            # operand: prefix operators, then nud
+            t = self.token
+            self.advance()
+            while t.prefix_bp is not None:
+                stack.append((t, None, rbp))
+                rbp = t.prefix_bp
+                t = self.token
+                self.advance()
+            left = t.nud(self)
+
+            while True:
+                if rbp < self.token.lbp:
+                    t = self.token
+                    self.advance()
+                    if t.infix_rbp is not None or t.assign:
+                        # parse the right operand
+                        stack.append((t, left, rbp))
+                        rbp = t.lbp - 1 if t.assign else t.infix_rbp
+                        break
+                    left = t.led(self,left)
+
+                elif stack:
+                    # operand done, complete the operator
+                    t, first, rbp = stack.pop()
+                    if first is None:
+                        left = prefix_node(t, left)
+                    elif t.assign:
+                        left = assign_node(t, self, first, left)
+                    else:
+                        left = infix_node(t, first, left)
+                    if self.expressions is not None and not t.assign:
+                        left = self.share(left)
+
+                else:
+                    return left
+
+
+    def share (self, node):
+
+        """Hash-consing of the prefix or infix operator <node>, operands done:
+        return the equal node parsed before, or <node> (shared from now on).
+        Only when its operands are leaves or shared nodes: then equal means
+        same operator and same operand objects, no deep comparison.
+        """
+
+        key = node_key(node)
+        for x in key[2:]:
+            if x not in self.shared and not (x.arity is None and (x.id == "Name" or x.id == "Const")):
+                return node
+        node = self.expressions.setdefault(key, node)
+        self.shared.add(node)
+        return node
+
+
+
+def node_key (node):
+
+    # operator and operands (the objects, hashed by identity), see Parser.share
+    if node.arity == 1:
+        return (node.id, 1, node.first)
+    return (node.id, node.arity, node.first, node.second)
+
+
+def ast(program, scope=None, engine="regex", intern=None):
 
     """Creates AST using Pratt's Parser
+    <program> -- source code string, an open file (read in chunks by the lexer)
+                 or lexer.TokenBuffer
+    <scope> -- Scope to use, a new one by default. See Parser
+    <intern> -- nodes shared, see Parser
     """
 
-    global token,next,level
-
-    next = tokenize(program).__next__ 
-    token = next()
-    level = 0
-    tree = parse()
-    return tree,SCOPE
+    return Parser(scope, engine, intern).ast(program)
  
 
 #--------------------------------------------------------------------------------------------
@@ -884,94 +1133,66 @@ class IndentationError(Exception):
 # OPTIONS
 
 
-def console ():
+def console (parser=None):
 
     """Interactive console for testing. Must change lexer's code, see debugging comments.
+    The same parser (and scope) is used for every line.
     -- commands:
         exit
         clear
     """
 
-    try:
-        while True:
-            expr = input (">> ")
-            if expr == "exit": exit()
-            if expr == "clear": 
-                os.system('clear')
-                console()
-            print (ast(expr)[0].first[0])
-
-    except Exception as e:
-        print (e.args[0])
-        console()
+    if parser is None: parser = Parser()
 
-
-if "--terminal" in sys.argv:
-
-    """Interactive terminal for testing
-    """
-
-    print ("Squanchy PL console test")
-    print ("v1.1","\n")
-    console()
-
-
-if "--img" in sys.argv:
-
-    """Test tree visualisation.
-    """
-    program = input (">> ")
-    tree,scope = ast(program)
-    print (program, "-> ",tree,"\n")
-    visu.visualise(tree)
+    while True:
+        try:
+            expr = input (">> ")
+        except EOFError:
+            print ()
+            return
+        if expr == "exit": exit()
+        if expr == "clear": 
+            os.system('clear')
+            continue
+        try:
+            print (parser.ast(expr)[0].first[0])
+        except Exception as e:
+            print (e.args[0] if e.args else e)
 
 
-if "--in" in sys.argv:
-    
-    """Test input
-    """
+def main():
 
-    f = open("code.sqy")
-    program = f.read()
-    f.close()
+    if "--terminal" in sys.argv:
 
-    program = program.replace("\n","\\n").replace("\t","\\t")
+        """Interactive terminal for testing
+        """
 
-    tree,scope = ast(program)
-    print ("\n",tree)
-    print ("\n",scope)
-    
+        print ("Squanchy PL console test")
+        print ("v1.1","\n")
+        console()
 
-if "--benchmark" in sys.argv:
-    factor = 1
-    program = '1+1+1+1+1+1+1+1+1'*10000
 
-    measure = []
+    if "--img" in sys.argv:
 
-    for i in range(factor):
-        measure.append([])
-        for j in range(1000):
-            start = time.time()
-            ast(program)
-            end = time.time()
-            measure[i].append(float(end-start))
-        program = ((program + '+')*10)[:-1]
+        """Test tree visualisation.
+        """
+        import visualiser as visu
+        program = input (">> ")
+        tree,scope = ast(program)
+        print (program, "-> ",tree,"\n")
+        visu.visualise(tree)
 
-    print("Time: ", list(map(lambda x: mean(x), measure)))
 
+    if "--in" in sys.argv:
 
+        """Test input
+        """
 
-def main():
-	pass
+        with open("code.sqy") as f:
+            tree,scope = ast(f) # streaming lexer, see lexer.stream_lexer
+        print ("\n",tree)
+        print ("\n",scope)
 
 
 if __name__ == "__main__":
 	main()
-
-
-
-
-
-
-
-
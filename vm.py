@@ -0,0 +1,402 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 2018 Marcos V. Conde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+
+import sys
+import operator
+from array import array
+from myeval import operations, unary_operations, Evaluator, NotDefined
+
+
+#--------------------------------------------------------------------------------------------
+# BYTECODE
+#
+# tree,scope = ast(program)
+# code = Compiler().compile(tree)
+# run(code, scope.names)
+#
+# Interpreter for the programs where the LLVM compilation is not worth it.
+# The AST is compiled (without recursion, deep expressions like 1+1+...+1 are fine)
+# to instructions of two ints, opcode and argument, in an array('i'):
+#
+#   CONST i          push consts[i]
+#   LOAD i           push the variable names[i]
+#   STORE i          names[i] = top (the value stays, an assignment is an expression)
+#   POP              drop top
+#   BINARY i         first,second -> binary_ops[i](first, second)
+#   UNARY i          second -> unary_ops[i](second)
+#   JUMP i           go to i
+#   JUMP_IF_FALSE i  pop, go to i if false
+#   PRINT n          pop n values and print them, push None
+#
+# Values as in the interpreter mode of myeval (Evaluator), but the strings without
+# quotes and print like the compiled program (printf "%lld", "%.16g").
+
+
+CONST, LOAD, STORE, POP, BINARY, UNARY, JUMP, JUMP_IF_FALSE, PRINT = range(9)
+
+opnames = ("CONST", "LOAD", "STORE", "POP", "BINARY", "UNARY", "JUMP", "JUMP_IF_FALSE", "PRINT")
+
+binary_ops = tuple(operations)
+unary_ops = tuple(unary_operations)
+
+binary_index = {op: i for i, op in enumerate(binary_ops)}
+unary_index = {op: i for i, op in enumerate(unary_ops)}
+
+assignments = (":", ":=")
+statements = ("while", "if", "Function", "global")
+
+MISSING = object() # variable without value
+
+# the same as the lambdas of myeval.operations, without the Python call
+native = {"+": operator.add, "-": operator.sub, "*": operator.mul, "%": operator.mod,
+          "**": operator.pow, "!=": operator.ne, "=": operator.eq, "<": operator.lt,
+          ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+native_unary = {"-": operator.neg, "not": operator.not_}
+
+
+class CompileError(Exception):
+    pass
+
+
+class Code:
+
+    """Compiled program.
+    code -- array('i') of (opcode, argument)
+    consts -- constant pool
+    names -- variable names, LOAD/STORE argument is the index
+    """
+
+    __slots__ = ("code", "consts", "names")
+
+    def __init__ (self, code, consts, names):
+
+        self.code = code
+        self.consts = consts
+        self.names = names
+
+
+    def __repr__ (self):
+
+        return "\n".join(self.disassemble())
+
+
+    def disassemble (self):
+
+        for pc in range(0, len(self.code), 2):
+            op, arg = self.code[pc], self.code[pc+1]
+            if op == CONST:
+                detail = repr(self.consts[arg])
+            elif op in (LOAD, STORE):
+                detail = self.names[arg]
+            elif op == BINARY:
+                detail = binary_ops[arg]
+            elif op == UNARY:
+                detail = unary_ops[arg]
+            else:
+                detail = ""
+            yield "%5d %-14s %5d %s" % (pc, opnames[op], arg, detail)
+
+
+#--------------------------------------------------------------------------------------------
+# COMPILER
+
+# tasks of the compiler stack
+STMT, EXPR, EMIT, LABEL, JUMP_TO = range(5)
+
+
+class Compiler:
+
+    """AST -> Code. Uses its own stack of tasks instead of recursion.
+    """
+
+    def __init__ (self):
+
+        self.code = array('i')
+        self.consts = []
+        self.const_index = {}
+        self.names = []
+        self.name_index = {}
+        self.patches = [] # (position of the argument, label)
+
+
+    def compile (self, tree):
+
+        """Compiles the Module node <tree>. The value of the last statement,
+        if it is an expression, is the result of run().
+        """
+
+        body = tree.first or []
+        tasks = []
+        for i, node in enumerate(body):
+            if i == len(body) - 1 and not self.is_statement(node):
+                tasks.append((EXPR, node))
+            else:
+                tasks.append((STMT, node))
+        tasks.reverse()
+        self.process(tasks)
+
+        for position, label in self.patches:
+            self.code[position] = label[0]
+        return Code(self.code, self.consts, self.names)
+
+
+    @staticmethod
+    def is_statement (node):
+
+        return node is None or node.id in statements
+
+
+    def emit (self, op, arg=0):
+
+        self.code.append(op)
+        self.code.append(arg)
+
+
+    def const (self, value):
+
+        try:
+            key = (type(value), value)
+            index = self.const_index.get(key)
+        except TypeError: # not hashable
+            key, index = None, None
+        if index is None:
+            index = len(self.consts)
+            self.consts.append(value)
+            if key is not None:
+                self.const_index[key] = index
+        return index
+
+
+    def name (self, name):
+
+        index = self.name_index.get(name)
+        if index is None:
+            index = self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+
+    def process (self, tasks):
+
+        """Runs the <tasks> stack (last task first).
+        """
+
+        push = tasks.append
+        while tasks:
+            task = tasks.pop()
+            kind = task[0]
+
+            if kind == EXPR:
+                self.expression(task[1], push)
+            elif kind == EMIT:
+                self.emit(task[1], task[2])
+            elif kind == STMT:
+                self.statement(task[1], push)
+            elif kind == LABEL:
+                task[1][0] = len(self.code)
+            else: # JUMP_TO
+                self.emit(task[1])
+                self.patches.append((len(self.code) - 1, task[2]))
+
+
+    def block (self, nodes, push):
+
+        # statement list, the tasks are pushed in reverse order
+        for node in reversed(nodes or []):
+            push((STMT, node))
+
+
+    def statement (self, node, push):
+
+        if node is None:
+            return
+        id = node.id
+
+        if id == "while":
+            start, end = [0], [0]
+            push((LABEL, end))
+            push((JUMP_TO, JUMP, start))
+            self.block(node.second, push)
+            push((JUMP_TO, JUMP_IF_FALSE, end))
+            push((EXPR, node.first))
+            push((LABEL, start))
+
+        elif id == "if":
+            orelse, end = [0], [0]
+            push((LABEL, end))
+            self.block(node.third, push)
+            push((LABEL, orelse))
+            push((JUMP_TO, JUMP, end))
+            self.block(node.second, push)
+            push((JUMP_TO, JUMP_IF_FALSE, orelse))
+            push((EXPR, node.first))
+
+        elif id == "Function" or id == "global":
+            pass # definitions, nothing to run
+
+        else:
+            push((EMIT, POP, 0))
+            push((EXPR, node))
+
+
+    def expression (self, node, push):
+
+        id = node.id
+
+        if id == "Name":
+            self.emit(LOAD, self.name(node.value))
+
+        elif id == "Const":
+            number = Evaluator.number(node)
+            if number is None:
+                value = node.value.strip('"') if isinstance(node.value, str) else node.value
+            else:
+                value = number
+            self.emit(CONST, self.const(value))
+
+        elif id in assignments:
+            if node.first is None or node.first.id != "Name":
+                raise CompileError("Cannot assign to %r" % node.first)
+            push((EMIT, STORE, self.name(node.first.value)))
+            push((EXPR, node.second))
+
+        elif node.name == "List" or node.name == "Tuple":
+            self.emit(CONST, self.const(str([x.value for x in node.first])))
+
+        elif node.arity == 2 and id in binary_index:
+            push((EMIT, BINARY, binary_index[id]))
+            push((EXPR, node.second))
+            push((EXPR, node.first))
+
+        elif node.arity == 1 and id in unary_index:
+            push((EMIT, UNARY, unary_index[id]))
+            push((EXPR, node.first))
+
+        elif id == "CallFunc" and node.first.value == "print":
+            args = node.second[0]
+            push((EMIT, PRINT, len(args)))
+            for arg in reversed(args):
+                push((EXPR, arg))
+
+        elif id == "CallFunc":
+            raise CompileError("Function calls are not supported by the VM (%s)" % node.first.value)
+
+        else:
+            raise CompileError("%s is not supported by the VM" % node.name)
+
+
+#--------------------------------------------------------------------------------------------
+# VIRTUAL MACHINE
+
+
+def load (value):
+
+    # value of a Name, like Evaluator.name
+    if type(value) is int or type(value) is list:
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def show (value):
+
+    # like printf "%lld" and "%.16g" for the numbers
+    if type(value) is int or type(value) is bool:
+        return str(int(value))
+    if type(value) is float:
+        return "%.16g" % value
+    return str(value)
+
+
+def run (code, names=None, output=None):
+
+    """Executes <code>. <names> -- dict of the variables, read and updated
+    (Scope.names). <output> -- file for print, sys.stdout by default.
+    Return the value of the last expression of the program or None.
+    """
+
+    if names is None:
+        names = {}
+    if output is None:
+        output = sys.stdout
+
+    ops = code.code
+    consts = code.consts
+    values = [load(names[name]) if name in names else MISSING for name in code.names]
+    binary = [native.get(op, operations[op]) for op in binary_ops]
+    unary = [native_unary.get(op, unary_operations[op]) for op in unary_ops]
+
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    pc = 0
+    end = len(ops)
+
+    try:
+        while pc < end:
+            op = ops[pc]
+            arg = ops[pc+1]
+            pc += 2
+
+            if op == CONST:
+                push(consts[arg])
+            elif op == LOAD:
+                value = values[arg]
+                if value is MISSING:
+                    raise NotDefined('Name "%s" is not defined' % code.names[arg])
+                push(value)
+            elif op == BINARY:
+                second = pop()
+                stack[-1] = binary[arg](stack[-1], second)
+            elif op == STORE:
+                values[arg] = stack[-1]
+            elif op == POP:
+                pop()
+            elif op == JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif op == JUMP:
+                pc = arg
+            elif op == UNARY:
+                stack[-1] = unary[arg](stack[-1])
+            elif op == PRINT:
+                args = stack[len(stack)-arg:]
+                del stack[len(stack)-arg:]
+                output.write("".join(map(show, args)) + "\n")
+                push(None)
+            else:
+                raise CompileError("Bad opcode %d" % op)
+    finally:
+        for name, value in zip(code.names, values):
+            if value is not MISSING:
+                names[name] = value
+
+    return stack[-1] if stack else None
+
+
+def interpret (tree, names=None, output=None):
+
+    """Compiles and runs the Module node <tree>, see run.
+    The values of the parser scope are the last ones of each name,
+    the program runs with its own <names> (new by default).
+    """
+
+    code = Compiler().compile(tree)
+    return run(code, names, output)